@@ -1,15 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, current_app, send_file
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, flash, jsonify, current_app, stream_with_context
 from dotenv import load_dotenv
 load_dotenv()
 from config import Config
-from models import db, Settings, Campaign, EmailLog, CampaignAttachment
-from utils import encrypt_password, decrypt_password, send_email_smtp
-import pandas as pd
+from models import db, Settings, Campaign, CampaignColumns, EmailLog, CampaignAttachment, SendJob, ImportJob, TrackingEvent
+from importer import (RecipientImporter, expire_stale_imports, open_records, parse_manual_emails,
+                      run_import_job)
+from tracking import tracking_buffer, link_click_counts, backfill_tracking_events
+from migrations import init_app as init_schema
+from progress import progress_cache, progress_etag
+from credentials import credential_cache
+import metrics
+from tracking_routes import tracking_bp
+from reports import (campaign_stats, log_page, iter_export_csv, STATUS_FILTERS,
+                     campaign_page, campaign_totals, parse_campaign_cursor, rollup_engagement)
+import click
+import json
 import threading
 import time
 import os
 import re
-from io import BytesIO
+import uuid
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from sqlalchemy import func
@@ -17,14 +27,21 @@ from sqlalchemy import func
 app = Flask(__name__)
 app.config.from_object(Config)
 db.init_app(app)
+tracking_buffer.init_app(app)
+progress_cache.init_app(app)
+credential_cache.init_app(app)
+app.register_blueprint(tracking_bp)
 
 # ensure upload folder exists
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
-# Create tables on startup (Essential for Vercel/Serverless where persistence is ephemeral)
-with app.app_context():
-    db.create_all()
+# Create/upgrade tables on the first request rather than at import, so cold
+# starts stay cheap (Essential for Vercel/Serverless where persistence is ephemeral)
+init_schema(app)
+
+# Sending, encryption and the worker are imported by the routes that use
+# them; a dashboard or tracking cold start doesn't load smtplib/cryptography.
 
 @app.template_filter('clean_error')
 def clean_error_filter(s):
@@ -42,7 +59,7 @@ def clean_error_filter(s):
 @app.errorhandler(500)
 def internal_error(error):
     # Log the actual error for debugging
-    print(f"Server Error: {error}")
+    metrics.error('web', f"Server Error: {error}")
     return render_template('error.html'), 500
 
 @app.errorhandler(Exception)
@@ -53,129 +70,132 @@ def handle_exception(e):
         return e
 
     # handle non-HTTP errors (like DB connection, ProgrammingError)
-    print(f"Unhandled Exception: {e}")
+    metrics.error('web', f"Unhandled Exception: {e}")
     return render_template('error.html'), 500
 
-def send_campaign_background(app, campaign_id, base_url, sender_email=None, sender_password=None):
-    """Background task to send emails for a campaign."""
+def send_campaign_background(app, job_id):
+    """
+    Inline fallback: works a queued job from inside the web process until
+    nothing is claimable. Retries that aren't due yet (or that no healthy
+    sender can take) are left to `python -m worker`, or to
+    resume_stale_job() when the campaign is started again; a web thread
+    never sleeps through a retry backoff.
+    """
+    from worker import make_worker_id, process_job
+    worker_id = make_worker_id()
     with app.app_context():
-        campaign = Campaign.query.get(campaign_id)
-        
-        # Resolve Credentials (Explicit > DB)
-        if not sender_email or not sender_password:
-            settings = Settings.query.first()
-            if settings:
-                sender_email = sender_email or settings.email
-                try:
-                    if not sender_password:
-                        sender_password = decrypt_password(settings.encrypted_password)
-                except Exception as e:
-                    print(f"Decryption failed: {e}")
-                    return
-        
-        if not campaign or not sender_email or not sender_password:
-            print(f"Campaign {campaign_id} missing or Credentials missing.")
-            return
-
-        pending_emails = EmailLog.query.filter_by(campaign_id=campaign_id, status='pending').all()
-        
-        # Get attachments
-        attachments = [att.filepath for att in campaign.attachments]
-
-        for email_log in pending_emails:
-            # Personalization
-            subject = campaign.subject
-            content = campaign.content_html
-            
-            # 1. Merge Tags
-            if email_log.merge_data:
-                try:
-                    for key, value in email_log.merge_data.items():
-                        if value:
-                            placeholder = "{{" + str(key) + "}}"
-                            subject = subject.replace(placeholder, str(value))
-                            content = content.replace(placeholder, str(value))
-                except Exception as e:
-                    print(f"Personalization error: {e}")
-
-            # 2. Inject Tracking Pixel (Open Rate)
-            # Create tracking URL: base_url/track/open/<log_id>
-            # We must use the log.id.
-            
-            tracking_pixel_url = f"{base_url}/track/open/{email_log.id}"
-            tracking_pixel_html = f'<img src="{tracking_pixel_url}" width="1" height="1" style="display:none;" />'
-            
-            # Append to end of content
-            if "</body>" in content:
-                content = content.replace("</body>", f"{tracking_pixel_html}</body>")
-            else:
-                content += tracking_pixel_html
-
-            # 3. Wrap Links (Click Rate) - Simple Regex
-            # Find all <a href="..."> tags
-            # We need to be careful not to break mailto: or layout links
-            # Regex to find hrefs that start with http/https
-            def replace_link(match):
-                original_url = match.group(1)
-                # Skip if already tracked or special protocol (though regex limits to http)
-                if '/track/' in original_url: return match.group(0)
-                
-                # Encode target URL
-                from urllib.parse import quote
-                encoded_url = quote(original_url)
-                tracking_link = f"{base_url}/track/click/{email_log.id}?url={encoded_url}"
-                return f'href="{tracking_link}"'
-
-            # Regex: href=" (http[s]?://...?) "
-            # Handles double quotes. Todo: handle single quotes too if needed.
-            content = re.sub(r'href="(http[s]?://[^"]+)"', replace_link, content)
-            
-            success, error = send_email_smtp(
-                sender_email, 
-                sender_password, 
-                email_log.email, 
-                subject, 
-                content,
-                attachments=attachments
-            )
-            
-            if success:
-                email_log.status = 'sent'
-                campaign.sent_count += 1
-            else:
-                email_log.status = 'failed'
-                email_log.error_message = error
-                campaign.failed_count += 1
-            
-            db.session.commit()
-            
-            # Anti-blocking delay
-            time.sleep(3) 
+        try:
+            while process_job(job_id, worker_id, app.config):
+                pass
+        except Exception as e:
+            db.session.rollback()
+            metrics.error('worker', f"Send job {job_id} failed: {e}")
+
+def _form_limit(name, cast):
+    """Reads an optional positive send-limit field from the submitted form."""
+    try:
+        value = cast(request.form.get(name) or 0)
+    except ValueError:
+        return None
+    return value if value > 0 else None
 
 @app.route('/')
 def dashboard():
-    campaigns = Campaign.query.order_by(Campaign.created_at.desc()).all()
-    return render_template('dashboard.html', campaigns=campaigns)
+    search = request.args.get('q', '').strip()
+    since = _form_date(request.args.get('since'))
+    until = _form_date(request.args.get('until'))
+    campaigns, newer, older = campaign_page(
+        search=search, since=since, until=until,
+        older=parse_campaign_cursor(request.args.get('older')),
+        newer=parse_campaign_cursor(request.args.get('newer')),
+        size=app.config.get('DASHBOARD_PAGE_SIZE', 25)
+    )
+    total_campaigns, total_sent = campaign_totals()
+    expire_stale_imports(app.config['IMPORT_STALE_SECONDS'])
+    importing = {row.campaign_id for row in db.session.query(ImportJob.campaign_id)
+                 .filter(ImportJob.campaign_id.in_([c.id for c in campaigns]), ImportJob.status == 'running')}
+    filters = {k: v for k, v in (('q', search), ('since', request.args.get('since')),
+                                 ('until', request.args.get('until'))) if v and (k == 'q' or _form_date(v))}
+    return render_template('dashboard.html', campaigns=campaigns, newer=newer, older=older,
+                           filters=filters, total_campaigns=total_campaigns, total_sent=total_sent,
+                           importing=importing)
+
+def _form_date(value):
+    """Parses a YYYY-MM-DD query arg; invalid or missing gives None."""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def _save_sender(settings):
+    """Applies the submitted sender form to a Settings row (new if None) and re-enables it."""
+    from utils import encrypt_password
+    email = request.form.get('email')
+    password = request.form.get('password')
+
+    if settings:
+        settings.email = email
+        settings.encrypted_password = encrypt_password(password)
+    else:
+        settings = Settings(email=email, encrypted_password=encrypt_password(password))
+        db.session.add(settings)
+
+    settings.rate_per_second = _form_limit('rate_per_second', float)
+    settings.burst = _form_limit('burst', int)
+    settings.max_connections = _form_limit('max_connections', int)
+    settings.daily_quota = _form_limit('daily_quota', int)
+    # New credentials get a fresh chance
+    settings.status = 'active'
+    settings.paused_until = None
+    settings.last_error = None
+
+    db.session.commit()
+    credential_cache.invalidate()
+    return settings
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
-    settings = Settings.query.first()
+    settings = Settings.query.order_by(Settings.id).first()
     if request.method == 'POST':
         email = request.form.get('email')
-        password = request.form.get('password')
-        
-        if settings:
-            settings.email = email
-            settings.encrypted_password = encrypt_password(password)
-        else:
-            new_settings = Settings(email=email, encrypted_password=encrypt_password(password))
-            db.session.add(new_settings)
-        
-        db.session.commit()
+        if settings and Settings.query.filter(Settings.email == email, Settings.id != settings.id).first():
+            # Settings.email is unique; the address already has its own row
+            flash(f'{email} is already in the sender pool. Update it there, or remove it first.', 'error')
+            return redirect(url_for('settings'))
+        _save_sender(settings)
         flash('Settings updated successfully!', 'success')
         return redirect(url_for('settings'))
-        
-    return render_template('settings.html', settings=settings)
+
+    senders = Settings.query.order_by(Settings.id).all()
+    return render_template('settings.html', settings=settings, senders=senders,
+                           now=datetime.utcnow())
+
+@app.route('/settings/senders', methods=['POST'])
+def add_sender():
+    """Adds a sender account to the pool (or updates the one with this address)."""
+    _save_sender(Settings.query.filter_by(email=request.form.get('email')).first())
+    flash('Sender account saved!', 'success')
+    return redirect(url_for('settings'))
+
+@app.route('/settings/senders/<int:sender_id>/resume', methods=['POST'])
+def resume_sender(sender_id):
+    sender = Settings.query.get_or_404(sender_id)
+    sender.status = 'active'
+    sender.paused_until = None
+    sender.last_error = None
+    db.session.commit()
+    credential_cache.invalidate()
+    flash(f'{sender.email} is sending again.', 'success')
+    return redirect(url_for('settings'))
+
+@app.route('/settings/senders/<int:sender_id>/delete', methods=['POST'])
+def delete_sender(sender_id):
+    sender = Settings.query.get_or_404(sender_id)
+    db.session.delete(sender)
+    db.session.commit()
+    credential_cache.invalidate()
+    flash(f'{sender.email} removed.', 'success')
+    return redirect(url_for('settings'))
 
 @app.route('/campaign/new', methods=['GET', 'POST'])
 def new_campaign():
@@ -186,63 +206,35 @@ def new_campaign():
         manual_emails_raw = request.form.get('manual_emails')
         attachment_files = request.files.getlist('attachments')
         
-        emails = []
-
-        # 1. Process CSV/Excel if provided
-        if csv_file and csv_file.filename:
+        manual_emails = parse_manual_emails(manual_emails_raw)
+        has_file = bool(csv_file and csv_file.filename)
+
+        # 1. Open the CSV/Excel upload and check its header up front
+        records = None
+        import_path = None
+        if has_file:
+            csv_file.stream.seek(0, os.SEEK_END)
+            background = csv_file.stream.tell() > app.config['IMPORT_BACKGROUND_BYTES']
+            csv_file.stream.seek(0)
             try:
-                filename = csv_file.filename.lower()
-                if filename.endswith('.csv'):
-                    df = pd.read_csv(csv_file)
-                elif filename.endswith(('.xls', '.xlsx')):
-                    df = pd.read_excel(csv_file)
+                if background:
+                    # Large uploads go to disk and are imported in the background
+                    import_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'imports')
+                    os.makedirs(import_dir, exist_ok=True)
+                    import_path = os.path.join(import_dir, f"{uuid.uuid4().hex}_{secure_filename(csv_file.filename)}")
+                    csv_file.save(import_path)
+                    with open(import_path, 'rb') as stream:
+                        open_records(stream, csv_file.filename)
                 else:
-                    flash('Invalid file type. Please upload a CSV or Excel file.', 'error')
-                    return redirect(url_for('new_campaign'))
-                # Normalize column names to lowercase for easier matching, but keep original for data
-                df.columns = [c.strip() for c in df.columns]
-                
-                email_col = next((col for col in df.columns if 'email' in col.lower()), None)
-                
-                if email_col:
-                    # Convert to list of dicts: [{'email': '...', 'name': '...', ...}, ...]
-                    records = df.where(pd.notnull(df), None).to_dict(orient='records')
-                    
-                    for record in records:
-                        email = record.get(email_col)
-                        if email:
-                            # Add to emails list for unique check check (simple string list)
-                            # But we need to store the full record. 
-                            # Strategy: Store record in a separate dict mapped by email
-                            if email not in [e['email'] for e in emails if isinstance(e, dict)]:
-                                # Normalize record keys? No, keep as is.
-                                # But we need to rename email_col to 'email' for internal consistency if it differs
-                                record['email'] = email 
-                                emails.append(record)
-                else:
-                     flash('CSV must contain an "email" column.', 'error')
-                     return redirect(url_for('new_campaign'))
-
+                    records = open_records(csv_file.stream, csv_file.filename)
             except Exception as e:
-                flash(f'Error processing CSV: {str(e)}', 'error')
+                if import_path and os.path.exists(import_path):
+                    os.remove(import_path)
+                message = str(e) if isinstance(e, ValueError) else f'Error processing CSV: {str(e)}'
+                flash(message, 'error')
                 return redirect(url_for('new_campaign'))
 
-        # 2. Process Manual Emails
-        if manual_emails_raw:
-            # Split by comma or newline, strip whitespace
-            manual_list = [e.strip() for e in manual_emails_raw.replace('\n', ',').split(',') if e.strip()]
-            for email in manual_list:
-                emails.append({'email': email}) # No merge data for manual yet
-
-        # Remove duplicates (distinct by email)
-        unique_emails = {}
-        for entry in emails:
-            if isinstance(entry, dict) and entry.get('email'):
-                unique_emails[entry['email']] = entry 
-        
-        final_list = list(unique_emails.values())
-
-        if not final_list:
+        if not has_file and not manual_emails:
             flash('No recipients found! Please upload a CSV or enter emails manually.', 'error')
             return redirect(url_for('new_campaign'))
             
@@ -250,45 +242,76 @@ def new_campaign():
         campaign = Campaign(
             subject=subject,
             content_html=content.replace('\n', '<br>'), 
-            total_emails=len(final_list)
+            total_emails=0,
+            rate_per_second=_form_limit('rate_per_second', float),
+            burst=_form_limit('burst', int),
+            max_connections=_form_limit('max_connections', int)
         )
         db.session.add(campaign)
+        import_job = None
+        if import_path:
+            # Committed with the campaign, so it can't be sent before its import starts
+            db.session.flush()
+            import_job = ImportJob(campaign_id=campaign.id, filename=csv_file.filename)
+            db.session.add(import_job)
         db.session.commit()
         
-        # Handle Attachments
+        # Handle Attachments (stored once per content, see blobs.py)
         if attachment_files:
+            from blobs import get_blob_store
+            store = get_blob_store()
             for file in attachment_files:
                 if file and file.filename:
                     filename = secure_filename(file.filename)
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(filepath)
+                    digest, filepath, size = store.save(file.stream)
                     
                     attachment = CampaignAttachment(
                         campaign_id=campaign.id,
                         filename=filename,
-                        filepath=filepath
+                        filepath=filepath,
+                        sha256=digest,
+                        size=size
                     )
                     db.session.add(attachment)
             db.session.commit()
 
-        # Create Email Logs
-        for entry in final_list:
-            # entry is a dict {'email': '...', 'name': '...', ...}
-            email_address = entry['email']
-            # Remove email from merge_data to avoid redundancy (optional, but cleaner)
-            # Keep all data including email for personalization
-            merge_data = entry
-            
-            log = EmailLog(
-                campaign_id=campaign.id,
-                email=email_address.strip(),
-                status='pending',
-                merge_data=merge_data 
+        # 2. Large uploads are imported in the background
+        if import_job:
+            thread = threading.Thread(
+                target=run_import_job,
+                args=(current_app._get_current_object(), import_job.id, import_path, manual_emails)
             )
-            db.session.add(log)
+            thread.start()
+
+            flash('Campaign created! Recipients are being imported in the background.', 'success')
+            return redirect(url_for('dashboard'))
+
+        # 3. Small uploads and manual emails are imported right away
+        importer = RecipientImporter(campaign.id, batch_size=app.config['IMPORT_BATCH_SIZE'])
+        try:
+            if records is not None:
+                importer.add_rows(*records)
+            for email in manual_emails:
+                importer.add(email)
+            importer.flush()
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error processing CSV: {str(e)}', 'error')
+            return redirect(url_for('new_campaign'))
+
+        if not importer.imported:
+            # Their blobs are left for the next gc-attachments
+            db.session.query(CampaignAttachment).filter_by(campaign_id=campaign.id).delete()
+            db.session.query(CampaignColumns).filter_by(campaign_id=campaign.id).delete()
+            db.session.delete(campaign)
+            db.session.commit()
+            flash('No recipients found! Please upload a CSV or enter emails manually.', 'error')
+            return redirect(url_for('new_campaign'))
+
+        campaign.total_emails = importer.imported
         db.session.commit()
         
-        flash(f'Campaign created with {len(emails)} emails!', 'success')
+        flash(f'Campaign created with {importer.imported} emails!', 'success')
         return redirect(url_for('dashboard'))
 
     return render_template('campaign.html')
@@ -301,36 +324,116 @@ def send_campaign(campaign_id):
 
     # Fallback to DB if not provided
     if not sender_email or not sender_password:
-        settings = Settings.query.first()
-        if not settings:
+        if not credential_cache.default():
             flash('Please configure settings first!', 'error')
             return redirect(url_for('settings'))
     
-    # Pass credentials to background task
+    Campaign.query.get_or_404(campaign_id)
+    expire_stale_imports(current_app.config['IMPORT_STALE_SECONDS'])
+    if ImportJob.query.filter_by(campaign_id=campaign_id, status='running').first():
+        flash('Recipients are still being imported. Please try again shortly.', 'error')
+        return redirect(url_for('dashboard'))
+
+    # Queue the campaign; workers pick it up (credentials are stored encrypted)
+    from worker import enqueue_campaign, resume_stale_job
     base_url = request.url_root.rstrip('/')
-    thread = threading.Thread(
-        target=send_campaign_background, 
-        args=(current_app._get_current_object(), campaign_id, base_url, sender_email, sender_password)
-    )
-    thread.start()
+    job = enqueue_campaign(campaign_id, base_url, sender_email, sender_password)
+    if not job and current_app.config['SEND_INLINE_WORKER']:
+        # An inline send whose thread died (recycle, timeout, deploy) is picked up again
+        job = resume_stale_job(campaign_id, current_app.config['WORKER_LEASE_SECONDS'],
+                               sender_email, sender_password)
+    if not job:
+        flash('This campaign has already been started.', 'error')
+        return redirect(url_for('dashboard'))
+
+    if current_app.config['SEND_INLINE_WORKER']:
+        thread = threading.Thread(
+            target=send_campaign_background, 
+            args=(current_app._get_current_object(), job.id)
+        )
+        thread.start()
     
     flash('Campaign started! Emails are being sent in the background.', 'success')
     return redirect(url_for('dashboard'))
 
 @app.route('/campaign/<int:campaign_id>/status')
 def campaign_status(campaign_id):
-    campaign = Campaign.query.get_or_404(campaign_id)
+    progress = progress_cache.get(campaign_id)
+    if progress is None:
+        abort(404)
+    response = jsonify(progress)
+    # Pollers revalidate with If-None-Match and get a 304 until counters move
+    response.set_etag(progress_etag(campaign_id, progress))
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# Open progress streams in this process (see PROGRESS_STREAM_MAX)
+stream_slots = threading.BoundedSemaphore(max(1, app.config['PROGRESS_STREAM_MAX']))
+
+@app.route('/campaigns/progress/stream')
+def campaign_progress_stream():
+    """
+    Server-sent events with progress for several campaigns in one stream.
+    Watches ?ids=1,2,3, or every campaign with an active send job. Each
+    `progress` event carries only the campaigns that changed since the
+    last one. The stream ends after PROGRESS_STREAM_SECONDS and the
+    browser reconnects, so it never pins a server worker for long. Past
+    PROGRESS_STREAM_MAX open streams the answer is a 503, and the
+    dashboard falls back to polling /campaign/<id>/status.
+    """
+    if not app.config['PROGRESS_STREAM_MAX'] or not stream_slots.acquire(blocking=False):
+        return Response('Too many progress streams; poll /campaign/<id>/status instead.\n',
+                        status=503, headers={'Retry-After': '30'}, mimetype='text/plain')
+    ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip().isdigit()]
+    interval = app.config.get('PROGRESS_STREAM_INTERVAL', 1.0)
+    duration = app.config.get('PROGRESS_STREAM_SECONDS', 60)
+
+    def events():
+        yield 'retry: 2000\n\n'
+        last = {}
+        deadline = time.monotonic() + duration
+        last_write = time.monotonic()
+        while time.monotonic() < deadline:
+            try:
+                current = progress_cache.get_many(ids or progress_cache.active_ids())
+            finally:
+                # Don't hold a pooled connection between ticks
+                db.session.close()
+            changed = {cid: p for cid, p in current.items() if last.get(cid) != p}
+            if changed:
+                last.update(changed)
+                yield f'event: progress\ndata: {json.dumps(changed)}\n\n'
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write >= 15:
+                # Keeps proxies from closing an idle connection
+                yield ': ping\n\n'
+                last_write = time.monotonic()
+            time.sleep(interval)
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also runs if the client goes away before the first event
+    response.call_on_close(stream_slots.release)
+    return response
+
+@app.route('/campaign/<int:campaign_id>/import-status')
+def import_status(campaign_id):
+    expire_stale_imports(app.config['IMPORT_STALE_SECONDS'])
+    job = ImportJob.query.filter_by(campaign_id=campaign_id).order_by(ImportJob.id.desc()).first_or_404()
     return jsonify({
-        'total': campaign.total_emails,
-        'sent': campaign.sent_count,
-        'failed': campaign.failed_count,
-        'status': 'completed' if (campaign.sent_count + campaign.failed_count) >= campaign.total_emails else 'processing'
+        'status': job.status,
+        'rows_read': job.rows_read,
+        'imported': job.imported,
+        'duplicates': job.duplicates,
+        'error': job.error_message
     })
 
 @app.route('/api/send-test', methods=['POST'])
 def send_test_email():
     """Send a single test email to the sender."""
-    if not Settings.query.first():
+    from utils import send_email_smtp
+    account = credential_cache.default()
+    if not account:
         return jsonify({'error': 'Please configure settings first!'}), 400
         
     data = request.json
@@ -340,10 +443,11 @@ def send_test_email():
     if not subject or not content:
         return jsonify({'error': 'Subject and Content are required'}), 400
         
-    settings = Settings.query.first()
-    sender_email = settings.email
+    sender_email = account.email
+    sender_password = account.password
+    if not sender_password:
+        return jsonify({'error': 'The saved password could not be decrypted. Please save your settings again.'}), 500
     try:
-        sender_password = decrypt_password(settings.encrypted_password)
         # Send to self
         success, error = send_email_smtp(
             sender_email, 
@@ -365,64 +469,64 @@ def send_test_email():
 @app.route('/campaign/<int:campaign_id>')
 def campaign_report(campaign_id):
     campaign = Campaign.query.get_or_404(campaign_id)
-    logs = EmailLog.query.filter_by(campaign_id=campaign_id).all()
-    return render_template('report.html', campaign=campaign, logs=logs)
+    status = request.args.get('status')
+    if status not in STATUS_FILTERS:
+        status = None
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+
+    logs, prev_before, next_after = log_page(
+        campaign_id, status=status, after=after, before=before,
+        size=app.config.get('REPORT_PAGE_SIZE', 100)
+    )
+    stats = campaign_stats(campaign_id)
+    top_links = link_click_counts(campaign_id, limit=10)
+    return render_template('report.html', campaign=campaign, logs=logs, stats=stats,
+                           status=status, status_filters=STATUS_FILTERS,
+                           prev_before=prev_before, next_after=next_after,
+                           top_links=top_links)
 
 @app.route('/campaign/<int:campaign_id>/export')
 def export_campaign_csv(campaign_id):
-    campaign = Campaign.query.get_or_404(campaign_id)
-    logs = EmailLog.query.filter_by(campaign_id=campaign_id).all()
-    
-    data = []
-    for log in logs:
-        data.append({
-            'Email': log.email,
-            'Status': log.status,
-            'Error': log.error_message or '',
-            'Time': log.sent_at.strftime('%Y-%m-%d %H:%M:%S') if log.sent_at else ''
-        })
-        
-    df = pd.DataFrame(data)
-    
-    # Send CSV file
-    from io import BytesIO
-    from flask import send_file
-    
-    output = BytesIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
-    
-    return send_file(
-        output,
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name=f'campaign_{campaign_id}_report.csv'
+    Campaign.query.get_or_404(campaign_id)
+    # ?gzip=1 sends a compressed .csv.gz instead
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = f'campaign_{campaign_id}_report.csv' + ('.gz' if compress else '')
+
+    rows = iter_export_csv(campaign_id, chunk_rows=app.config.get('EXPORT_CHUNK_ROWS', 1000), compress=compress)
+    return Response(
+        stream_with_context(rows),
+        mimetype='application/gzip' if compress else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
     )
 
 @app.route('/settings/reset_db', methods=['POST'])
 def reset_database():
     """Danger Zone: Clear all campaign data but keep settings."""
     verification_email = request.form.get('verification_email')
-    settings = Settings.query.first()
+    account = credential_cache.default()
     
-    if not settings or settings.email != verification_email:
+    if not account or account.email != verification_email:
         flash('Verification failed: Incorrect email address.', 'error')
         return redirect(url_for('settings'))
 
     try:
+        db.session.query(TrackingEvent).delete()
         db.session.query(EmailLog).delete()
+        db.session.query(CampaignColumns).delete()
+        db.session.query(SendJob).delete()
+        db.session.query(ImportJob).delete()
         db.session.query(CampaignAttachment).delete()
         db.session.query(Campaign).delete()
         db.session.commit()
+        progress_cache.invalidate()
         flash('Database reset successfully! All campaigns have been removed.', 'success')
-        # Clean up upload folder
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-             file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-             try:
-                 if os.path.isfile(file_path):
-                     os.unlink(file_path)
-             except Exception:
-                 pass
+        # Every attachment row is gone, so nothing can be mid-upload: no grace
+        from blobs import gc_attachments
+        try:
+            gc_attachments(grace=0)
+        except Exception as e:
+            metrics.error('attachments', f"Attachment cleanup failed: {e}")
     except Exception as e:
         db.session.rollback()
         flash(f'Error resetting database: {str(e)}', 'error')
@@ -471,49 +575,33 @@ def system_status_api():
             'database_type': "Unknown"
         }), 500
 
-# --- Tracking Routes ---
-@app.route('/track/open/<int:log_id>')
-def track_open(log_id):
-    """Records an email open event."""
-    try:
-        log = EmailLog.query.get(log_id)
-        if log and not log.opened_at:
-            log.opened_at = datetime.utcnow()
-            db.session.commit()
-    except Exception as e:
-        print(f"Tracking error: {e}")
-    # Return 1x1 transparent pixel
-    return send_file(BytesIO(b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa7\xd4\xd6\xe7\x00\x00\x00\x00IEND\xaeB`\x82'), mimetype='image/png')
-
-@app.route('/track/click/<int:log_id>')
-def track_click(log_id):
-    """Records a link click and redirects."""
-    target_url = request.args.get('url')
-    if not target_url:
-        return "Invalid Link", 400
-        
-    try:
-        log = EmailLog.query.get(log_id)
-        if log:
-            log.clicked_at = datetime.utcnow() # Update last clicked
-            # Append to history
-            current_clicks = log.links_clicked or []
-            if isinstance(current_clicks, list):
-                 current_clicks.append({'url': target_url, 'time': datetime.utcnow().isoformat()})
-                 log.links_clicked = current_clicks
-            
-            # Use flag_modified for JSON mutable tracking if needed, 
-            # but re-assigning usually works in recent SQLAlchemy
-            from sqlalchemy.orm.attributes import flag_modified
-            flag_modified(log, "links_clicked")
-            
-            db.session.commit()
-    except Exception as e:
-        print(f"Click tracking error: {e}")
-        
-    return redirect(target_url)
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target for this web process."""
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.cli.command('backfill-tracking-events')
+def backfill_tracking_events_command():
+    """Moves legacy links_clicked JSON into the tracking_event table."""
+    created = backfill_tracking_events()
+    print(f"Created {created} tracking events")
+
+@app.cli.command('gc-attachments')
+@click.option('--grace', default=3600, help='Keep unreferenced files younger than this many seconds.')
+def gc_attachments_command(grace):
+    """Deletes attachment files no campaign refers to."""
+    from blobs import gc_attachments
+    removed, freed = gc_attachments(grace=grace)
+    click.echo(f"Removed {removed} attachment files ({freed} bytes).")
+
+@app.cli.command('rollup-campaigns')
+@click.option('--full', is_flag=True, help='Recount every campaign, not just those with new events.')
+def rollup_campaigns_command(full):
+    """Refreshes the open/click totals stored on campaigns."""
+    updated = rollup_engagement(full=full, overlap=app.config.get('ROLLUP_OVERLAP', 1000))
+    print(f"Updated {updated} campaigns")
 
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
     app.run(debug=True, port=5000)
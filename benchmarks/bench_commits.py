@@ -0,0 +1,106 @@
+"""
+Benchmark: per-recipient ORM commits vs. batched ResultFlusher writes.
+
+    python benchmarks/bench_commits.py [--rows N] [--flush-rows N] [--database-url URL]
+
+Seeds a campaign with N pending logs in a throwaway SQLite file (or the
+given database), records a mix of sent/failed results both ways, and
+reports commits/sec and rows/sec.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import insert
+
+from models import db, Campaign, EmailLog
+from worker import ResultFlusher
+
+def make_app(database_url):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def seed(rows):
+    campaign = Campaign(subject='bench', content_html='<p>bench</p>', total_emails=rows)
+    db.session.add(campaign)
+    db.session.commit()
+    db.session.execute(insert(EmailLog), [
+        {'campaign_id': campaign.id, 'email': f'user{i}@example.com', 'status': 'pending',
+         'merge_data': {'email': f'user{i}@example.com'}}
+        for i in range(rows)
+    ])
+    db.session.commit()
+    ids = [row.id for row in db.session.query(EmailLog.id).filter_by(campaign_id=campaign.id).order_by(EmailLog.id)]
+    return campaign.id, ids
+
+def result_for(i):
+    return (False, 'Connection Timed Out') if i % 10 == 0 else (True, None)
+
+def legacy(campaign_id, ids):
+    """The original loop: ORM read-modify-write and a commit per recipient."""
+    campaign = Campaign.query.get(campaign_id)
+    for i, log_id in enumerate(ids):
+        email_log = EmailLog.query.get(log_id)
+        success, error = result_for(i)
+        if success:
+            email_log.status = 'sent'
+            campaign.sent_count += 1
+        else:
+            email_log.status = 'failed'
+            email_log.error_message = error
+            campaign.failed_count += 1
+        db.session.commit()
+    return len(ids)
+
+def batched(campaign_id, ids, flush_rows):
+    flusher = ResultFlusher(campaign_id, max_rows=flush_rows, max_ms=60_000)
+    for i, log_id in enumerate(ids):
+        flusher.add(log_id, result_for(i))
+    flusher.flush()
+    return flusher.flushes
+
+def report(name, elapsed, rows, commits):
+    print(f"  {name:8}: {elapsed:.3f}s  {commits / elapsed:,.0f} commits/s  {rows / elapsed:,.0f} rows/s")
+
+def run(rows, flush_rows, database_url):
+    app = make_app(database_url)
+    with app.app_context():
+        db.create_all()
+
+        campaign_id, ids = seed(rows)
+        start = time.perf_counter()
+        commits = legacy(campaign_id, ids)
+        legacy_time = time.perf_counter() - start
+
+        campaign_id, ids = seed(rows)
+        start = time.perf_counter()
+        flushes = batched(campaign_id, ids, flush_rows)
+        batched_time = time.perf_counter() - start
+
+        campaign = Campaign.query.get(campaign_id)
+        assert campaign.sent_count + campaign.failed_count == rows
+
+        print(f"rows={rows} flush_rows={flush_rows} db={db.engine.dialect.name}")
+        report('legacy', legacy_time, rows, commits)
+        report('batched', batched_time, rows, flushes)
+        print(f"  speedup : {legacy_time / batched_time:.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--flush-rows', type=int, default=100)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    url = args.database_url
+    if not url:
+        url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    run(args.rows, args.flush_rows, url)
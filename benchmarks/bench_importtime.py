@@ -0,0 +1,116 @@
+"""
+Cold start benchmark: import time of the app entry points.
+
+    python benchmarks/bench_importtime.py [--runs N] [--budget MODULE=MS ...] [--json FILE]
+
+Imports each entry point (the full app, and the minimal tracking_app) in a
+fresh interpreter under `python -X importtime`, then serves one request,
+as a serverless cold start would. Prints the median import and first
+request times and the modules with the most self time.
+
+Exits non-zero if an entry point pulls in a module it must not load at
+import time (see LAZY), or takes longer than its --budget, so it can
+guard against regressions in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# entry point -> the request a cold start serves
+ENTRY_POINTS = {
+    'app': '/',
+    'tracking_app': '/track/open/1',
+}
+
+# Modules only some features need; none of them may load on import
+LAZY = {
+    'app': ('cryptography', 'smtplib', 'openpyxl', 'pandas', 'worker', 'pipeline', 'transports', 'cProfile'),
+    'tracking_app': ('cryptography', 'smtplib', 'openpyxl', 'pandas', 'worker', 'pipeline', 'transports',
+                     'cProfile', 'utils', 'importer', 'reports', 'templating', 'engine'),
+}
+
+CHILD = """
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module} as entry
+imported = time.perf_counter()
+entry.app.test_client().get({path!r})
+print(f"{{(imported - start) * 1000:.3f}} {{(time.perf_counter() - imported) * 1000:.3f}}")
+"""
+
+def parse_importtime(stderr):
+    """[(self_us, cumulative_us, depth, name)] from -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+def measure(module, path):
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'cold.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               TRACKING_BUFFER='false')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD.format(root=ROOT, module=module, path=path)],
+                          env=env, capture_output=True, text=True, cwd=workdir)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{module} failed to start:\n{proc.stderr[-2000:]}")
+    import_ms, request_ms = (float(v) for v in proc.stdout.split()[-2:])
+    return import_ms, request_ms, parse_importtime(proc.stderr)
+
+def run(runs, budgets, top):
+    results, failures = {}, []
+    for module, path in ENTRY_POINTS.items():
+        samples = [measure(module, path) for _ in range(runs)]
+        import_ms = statistics.median(s[0] for s in samples)
+        request_ms = statistics.median(s[1] for s in samples)
+        rows = samples[len(samples) // 2][2]
+        loaded = {name for _, _, _, name in rows}
+        lazy = sorted(name for name in loaded
+                      if any(name == m or name.startswith(m + '.') for m in LAZY.get(module, ())))
+
+        print(f"== {module} ==")
+        print(f"  import {import_ms:8.1f} ms   first request {request_ms:8.1f} ms   {len(loaded)} modules")
+        for self_us, cumulative_us, _, name in sorted(rows, reverse=True)[:top]:
+            print(f"    {self_us / 1000:7.1f} ms self {cumulative_us / 1000:8.1f} ms cumulative  {name}")
+
+        if lazy:
+            failures.append(f"{module} imports {', '.join(lazy)} at startup")
+        budget = budgets.get(module)
+        if budget and import_ms > budget:
+            failures.append(f"{module} imports in {import_ms:.1f} ms, over its {budget:.0f} ms budget")
+        results[module] = {'import_ms': round(import_ms, 1), 'first_request_ms': round(request_ms, 1),
+                           'modules': len(loaded), 'lazy_violations': lazy}
+    return results, failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='modules to list by self time')
+    parser.add_argument('--budget', action='append', default=[], metavar='MODULE=MS')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    budgets = {}
+    for item in args.budget:
+        name, _, ms = item.partition('=')
+        budgets[name] = float(ms)
+
+    results, failures = run(args.runs, budgets, args.top)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,133 @@
+"""
+Benchmark: EmailLog hot queries with and without the composite indexes.
+
+    python benchmarks/bench_indexes.py [--rows N] [--campaigns N] [--database-url URL]
+
+Seeds N email_log rows (default 1,000,000) spread over several campaigns
+into a throwaway SQLite file, or the given database (e.g. a local
+Postgres), drops the email_log indexes, and prints the query plan and
+median time of each hot query. Then it runs the index migration and
+prints both again.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import insert, text
+
+from models import db, Campaign, EmailLog
+from migrations import upgrade, _email_log_indexes
+
+INDEXES = [ix.name for ix in EmailLog.__table__.indexes]
+
+# (name, SQL) with :cid bound to the campaign under test
+QUERIES = [
+    ('pending batch', "SELECT id FROM email_log WHERE campaign_id = :cid AND status = 'pending' ORDER BY id LIMIT 50"),
+    ('pending count', "SELECT count(*) FROM email_log WHERE campaign_id = :cid AND status = 'pending'"),
+    ('status counts', "SELECT status, count(id), count(opened_at), count(clicked_at) FROM email_log WHERE campaign_id = :cid GROUP BY status"),
+    ('report page', "SELECT id, email, status FROM email_log WHERE campaign_id = :cid ORDER BY id LIMIT 100"),
+    ('failed page', "SELECT id, email, status FROM email_log WHERE campaign_id = :cid AND status = 'failed' ORDER BY id LIMIT 100"),
+    ('opened page', "SELECT id, email FROM email_log WHERE campaign_id = :cid AND opened_at IS NOT NULL ORDER BY id LIMIT 100"),
+]
+
+def make_app(database_url):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def seed(rows, campaigns, chunk=50_000):
+    ids = []
+    for _ in range(campaigns):
+        campaign = Campaign(subject='bench', content_html='<p>bench</p>', total_emails=rows // campaigns)
+        db.session.add(campaign)
+        db.session.flush()
+        ids.append(campaign.id)
+    db.session.commit()
+
+    now = datetime.utcnow()
+    statuses = ('sent',) * 7 + ('failed', 'pending', 'pending')
+    for start in range(0, rows, chunk):
+        db.session.execute(insert(EmailLog), [
+            {'campaign_id': ids[i % campaigns], 'email': f'user{i}@example.com',
+             'status': statuses[i % len(statuses)], 'merge_data': {'email': f'user{i}@example.com'},
+             'opened_at': now if i % 5 == 0 else None}
+            for i in range(start, min(start + chunk, rows))
+        ])
+        db.session.commit()
+    return ids[len(ids) // 2]
+
+def plan(conn, sql, cid):
+    if conn.dialect.name == 'postgresql':
+        rows = conn.execute(text('EXPLAIN ' + sql), {'cid': cid})
+        return [row[0] for row in rows]
+    rows = conn.execute(text('EXPLAIN QUERY PLAN ' + sql), {'cid': cid})
+    return [row[-1] for row in rows]
+
+def timed(conn, sql, cid, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(text(sql), {'cid': cid}).fetchall()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+def measure(label, cid, repeat):
+    print(f"\n== {label} ==")
+    results = {}
+    with db.engine.connect() as conn:
+        for name, sql in QUERIES:
+            results[name] = timed(conn, sql, cid, repeat)
+            print(f"  {name:14} {results[name] * 1000:9.2f} ms")
+            for line in plan(conn, sql, cid):
+                print(f"      {line}")
+    return results
+
+def run(rows, campaigns, repeat, database_url):
+    app = make_app(database_url)
+    with app.app_context():
+        upgrade()
+        print(f"Seeding {rows:,} rows over {campaigns} campaigns ({db.engine.dialect.name})...")
+        start = time.perf_counter()
+        cid = seed(rows, campaigns)
+        print(f"  seeded in {time.perf_counter() - start:.1f}s")
+
+        with db.engine.begin() as conn:
+            for name in INDEXES:
+                conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+            conn.execute(text('ANALYZE'))
+        before = measure('without indexes', cid, repeat)
+
+        start = time.perf_counter()
+        with db.engine.connect() as conn:
+            _email_log_indexes(conn)
+            conn.commit()
+        with db.engine.begin() as conn:
+            conn.execute(text('ANALYZE'))
+        print(f"\n  indexes built in {time.perf_counter() - start:.1f}s")
+        after = measure('with indexes', cid, repeat)
+
+        print("\n== speedup ==")
+        for name, _ in QUERIES:
+            print(f"  {name:14} {before[name] / after[name]:8.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--campaigns', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    url = args.database_url
+    if not url:
+        url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    run(args.rows, args.campaigns, args.repeat, url)
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark: compiled templates vs. the original per-recipient
+str.replace/re.sub renderer.
+
+    python benchmarks/bench_templating.py [--recipients N] [--columns N] [--body-kb N]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from templating import CompiledTemplate
+
+def legacy_render(subject, content, merge_data, log_id, base_url):
+    """The renderer send_campaign_background used before templates were compiled."""
+    for key, value in merge_data.items():
+        if value:
+            placeholder = "{{" + str(key) + "}}"
+            subject = subject.replace(placeholder, str(value))
+            content = content.replace(placeholder, str(value))
+
+    tracking_pixel_html = f'<img src="{base_url}/track/open/{log_id}" width="1" height="1" style="display:none;" />'
+    if "</body>" in content:
+        content = content.replace("</body>", f"{tracking_pixel_html}</body>")
+    else:
+        content += tracking_pixel_html
+
+    def replace_link(match):
+        original_url = match.group(1)
+        if '/track/' in original_url: return match.group(0)
+        return f'href="{base_url}/track/click/{log_id}?url={quote(original_url)}"'
+
+    content = re.sub(r'href="(http[s]?://[^"]+)"', replace_link, content)
+    return subject, content
+
+def make_fixture(columns, body_kb):
+    fields = ['email', 'name'] + [f'col{i}' for i in range(columns - 2)]
+    paragraph = (
+        '<p>Hello {{name}}, here is an update about {{col0}}. '
+        'Read more at <a href="https://example.com/news?id={{col1}}">our site</a>.</p>\n'
+    )
+    body = '<html><body>' + paragraph * max(1, (body_kb * 1024) // len(paragraph)) + '</body></html>'
+    return 'Hi {{name}}, news for {{col0}}', body, fields
+
+def run(recipients, columns, body_kb):
+    subject, body, fields = make_fixture(columns, body_kb)
+    rows = [{f: f'{f}-{i}' for f in fields} for i in range(recipients)]
+    base_url = 'https://mail.example.com'
+
+    start = time.perf_counter()
+    legacy = [legacy_render(subject, body, row, i, base_url) for i, row in enumerate(rows)]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    template = CompiledTemplate(subject, body)
+    compiled = [template.render(row, i, base_url) for i, row in enumerate(rows)]
+    compiled_time = time.perf_counter() - start
+
+    assert legacy == compiled, "compiled output differs from legacy renderer"
+
+    print(f"recipients={recipients} columns={columns} body={len(body) // 1024}KB")
+    print(f"  legacy   : {legacy_time:.3f}s ({recipients / legacy_time:,.0f}/s)")
+    print(f"  compiled : {compiled_time:.3f}s ({recipients / compiled_time:,.0f}/s)")
+    print(f"  speedup  : {legacy_time / compiled_time:.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipients', type=int, default=2000)
+    parser.add_argument('--columns', type=int, default=20)
+    parser.add_argument('--body-kb', type=int, default=50)
+    args = parser.parse_args()
+    run(args.recipients, args.columns, args.body_kb)
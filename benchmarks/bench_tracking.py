@@ -0,0 +1,99 @@
+"""
+Load test for the open/click tracking routes.
+
+    python benchmarks/bench_tracking.py [--logs N] [--threads N] [--requests N] [--database-url URL]
+
+Drives /track/open and /track/click through the Flask test client from
+several threads, first with the write-behind buffer and then with every
+event written before the response, and reports latency percentiles and
+sustained events/sec for each.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def storm(app, log_ids, threads, requests_per_thread):
+    latencies = []
+    lock = threading.Lock()
+
+    def client_loop(offset):
+        client = app.test_client()
+        local = []
+        for i in range(requests_per_thread):
+            log_id = log_ids[(offset + i) % len(log_ids)]
+            start = time.perf_counter()
+            if i % 4 == 0:
+                client.get(f'/track/click/{log_id}?url=https%3A%2F%2Fexample.com%2F{i % 5}')
+            else:
+                client.get(f'/track/open/{log_id}')
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=client_loop, args=(t * 997,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    return sorted(latencies), elapsed
+
+def run(logs, threads, requests_per_thread):
+    from sqlalchemy import insert
+    import app as neurasend
+    from models import db, Campaign, EmailLog
+    from tracking import tracking_buffer
+
+    from migrations import upgrade
+
+    app = neurasend.app
+    with app.app_context():
+        upgrade()
+        campaign = Campaign(subject='bench', content_html='<p>bench</p>', total_emails=logs)
+        db.session.add(campaign)
+        db.session.commit()
+        db.session.execute(insert(EmailLog), [
+            {'campaign_id': campaign.id, 'email': f'user{i}@example.com', 'status': 'sent'}
+            for i in range(logs)
+        ])
+        db.session.commit()
+        log_ids = [row.id for row in db.session.query(EmailLog.id).filter_by(campaign_id=campaign.id)]
+
+    total = threads * requests_per_thread
+    print(f"logs={logs} threads={threads} requests={total} db={app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]}")
+    for label, buffered in (('buffered', True), ('write-through', False)):
+        tracking_buffer.enabled = buffered
+        latencies, elapsed = storm(app, log_ids, threads, requests_per_thread)
+        start = time.perf_counter()
+        tracking_buffer.flush()
+        drain = time.perf_counter() - start
+        ms = [v * 1000 for v in latencies]
+        print(f"  {label:13}: p50={percentile(ms, 50):.2f}ms p95={percentile(ms, 95):.2f}ms "
+              f"p99={percentile(ms, 99):.2f}ms max={ms[-1]:.2f}ms  "
+              f"{total / elapsed:,.0f} events/s (final flush {drain * 1000:.0f}ms)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logs', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500, help='requests per thread')
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = args.database_url or 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ.setdefault('UPLOAD_FOLDER', os.path.join(workdir, 'uploads'))
+    run(args.logs, args.threads, args.requests)
@@ -0,0 +1,359 @@
+"""
+End-to-end benchmark suite.
+
+    python benchmarks/run.py [--sizes 1000,10000,100000] [--database-url URL ...] [--output FILE]
+    python benchmarks/run.py --compare BASE.json NEW.json
+
+Drives the real Flask app through its test client:
+
+    import    CSV upload through /campaign/new, per size (large uploads are
+              imported in the background; the time includes waiting for it)
+    send      /campaign/<id>/send plus the worker's process_job against a
+              stand-in SMTP server on localhost (or --transport null)
+    tracking  a storm of /track/open and /track/click requests from
+              several threads, including the final buffer flush
+    report    the report page (all logs and one status filter) and the
+              full CSV export of the largest campaign
+
+Each database runs in its own process, since the app reads its settings at
+import time. SQLite is always run; a Postgres URL is taken from
+--database-url or BENCH_POSTGRES_URL and skipped if it can't be reached.
+It must be a throwaway database: its tables are dropped first.
+
+Results are written as JSON (default benchmarks/results/<time>-<commit>.json)
+and --compare prints the change of every metric between two such files.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# How --compare judges a metric by its name; other values (counts) are shown only
+HIGHER_IS_BETTER = ('_per_s',)
+LOWER_IS_BETTER = ('_ms', 'seconds')
+
+class _SMTPSink(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept and drop messages (no AUTH, no TLS)."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 bench ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb in (b'EHLO', b'HELO'):
+                self.reply('250 bench')
+            elif verb == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif verb == b'QUIT':
+                self.reply('221 Bye')
+                return
+            elif verb in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self.reply('250 OK')
+            else:
+                self.reply('500 Unrecognised command')
+
+def start_smtp_sink():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SMTPSink)
+    server.daemon_threads = True
+    server.messages = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+@contextlib.contextmanager
+def quiet():
+    # The app and worker print their stats; keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def recipients_csv(size, offset=0):
+    lines = ['email,name,company']
+    lines += [f'user{i}@example{i % 50}.com,User {i},Company {i % 7}' for i in range(offset, offset + size)]
+    return ('\n'.join(lines) + '\n').encode()
+
+def bench_import(client, app, sizes):
+    from models import db, Campaign, ImportJob
+    results, campaigns = [], {}
+    for size in sizes:
+        data = {
+            'subject': f'Hello {{{{name}}}} ({size})',
+            'content': 'Hi {{name}} from {{company}}, <a href="https://example.com/offer">see the offer</a>.',
+            'csv_file': (io.BytesIO(recipients_csv(size)), f'recipients_{size}.csv'),
+        }
+        start = time.perf_counter()
+        client.post('/campaign/new', data=data, content_type='multipart/form-data')
+        with app.app_context():
+            campaign_id = db.session.query(db.func.max(Campaign.id)).scalar()
+            while ImportJob.query.filter_by(campaign_id=campaign_id, status='running').first():
+                db.session.close()
+                time.sleep(0.05)
+            total = db.session.get(Campaign, campaign_id).total_emails
+        elapsed = time.perf_counter() - start
+        campaigns[size] = campaign_id
+        results.append({'scenario': 'import', 'size': size, 'seconds': round(elapsed, 3),
+                        'rows_per_s': round(total / elapsed, 1), 'imported': total})
+        print(f"  import   {size:>7,} rows: {elapsed:7.2f}s  {total / elapsed:10,.0f} rows/s")
+    return results, campaigns
+
+def bench_send(client, app, campaign_id, size):
+    from models import db, SendJob
+    from worker import process_job
+    start = time.perf_counter()
+    client.post(f'/campaign/{campaign_id}/send', data={'sender_email': 'bench@example.com',
+                                                        'sender_password': 'bench'})
+    with app.app_context():
+        job_id = SendJob.query.filter_by(campaign_id=campaign_id).one().id
+        with quiet():
+            handled = process_job(job_id, 'bench', app.config)
+    elapsed = time.perf_counter() - start
+    print(f"  send     {size:>7,} msgs: {elapsed:7.2f}s  {handled / elapsed:10,.0f} msgs/s")
+    return [{'scenario': 'send', 'size': size, 'seconds': round(elapsed, 3),
+             'messages_per_s': round(handled / elapsed, 1), 'sent': handled}]
+
+def bench_tracking(app, campaign_id, threads, total):
+    from models import db, EmailLog
+    from tracking import tracking_buffer
+    with app.app_context():
+        log_ids = [row.id for row in db.session.query(EmailLog.id).filter_by(campaign_id=campaign_id)]
+    per_thread = max(1, total // threads)
+    latencies, lock = [], threading.Lock()
+
+    def storm(offset):
+        client = app.test_client()
+        local = []
+        for i in range(per_thread):
+            log_id = log_ids[(offset + i) % len(log_ids)]
+            start = time.perf_counter()
+            if i % 4 == 0:
+                client.get(f'/track/click/{log_id}?url=https%3A%2F%2Fexample.com%2Foffer')
+            else:
+                client.get(f'/track/open/{log_id}')
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=storm, args=(t * 997,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    with app.app_context():
+        tracking_buffer.flush()
+    elapsed = time.perf_counter() - start
+
+    ms = sorted(v * 1000 for v in latencies)
+    events = len(ms)
+    print(f"  tracking {events:>7,} hits: {elapsed:7.2f}s  {events / elapsed:10,.0f} events/s  "
+          f"p50={percentile(ms, 50):.2f}ms p99={percentile(ms, 99):.2f}ms")
+    return [{'scenario': 'tracking', 'size': events, 'seconds': round(elapsed, 3),
+             'events_per_s': round(events / elapsed, 1), 'p50_ms': round(percentile(ms, 50), 3),
+             'p95_ms': round(percentile(ms, 95), 3), 'p99_ms': round(percentile(ms, 99), 3)}]
+
+def bench_report(client, campaign_id, size, repeat):
+    results = []
+    for label, url in (('report', f'/campaign/{campaign_id}'),
+                       ('report_filtered', f'/campaign/{campaign_id}?status=sent')):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            client.get(url)
+            samples.append(time.perf_counter() - start)
+        median = statistics.median(samples) * 1000
+        results.append({'scenario': label, 'size': size, 'median_ms': round(median, 3)})
+        print(f"  {label:15} {size:>7,}: {median:9.2f}ms median")
+
+    start = time.perf_counter()
+    response = client.get(f'/campaign/{campaign_id}/export')
+    exported = len(response.get_data())
+    elapsed = time.perf_counter() - start
+    results.append({'scenario': 'export', 'size': size, 'seconds': round(elapsed, 3),
+                    'rows_per_s': round(size / elapsed, 1), 'bytes': exported})
+    print(f"  export   {size:>7,} rows: {elapsed:7.2f}s  {size / elapsed:10,.0f} rows/s")
+    return results
+
+def run_database(args):
+    """Child process: everything against one database (see main())."""
+    with quiet():
+        import app as neurasend
+    from migrations import metadata as migration_metadata, upgrade
+    from models import db
+
+    app = neurasend.app
+    client = app.test_client()
+    with app.app_context():
+        db.drop_all()
+        migration_metadata.drop_all(db.engine)
+        with quiet():
+            upgrade()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results, campaigns = bench_import(client, app, sizes)
+
+    send_size = min(sizes, key=lambda s: abs(s - args.send_size))
+    results += bench_send(client, app, campaigns[send_size], send_size)
+    results += bench_tracking(app, campaigns[send_size], args.threads, args.tracking_requests)
+    results += bench_report(client, campaigns[max(sizes)], max(sizes), args.repeat)
+    return results
+
+def child_env(args, database_url, workdir):
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': database_url,
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'SEND_INLINE_WORKER': 'false',
+        # Limits out of the way; the benchmark measures our overhead
+        'SEND_RATE_PER_SECOND': '100000',
+        'SEND_BURST': '1000',
+        'SEND_MAX_CONNECTIONS': str(args.connections),
+        'SMTP_POOL_SIZE': str(args.connections),
+        'DOMAIN_CONCURRENCY': str(args.connections),
+        'SMTP_MAX_MESSAGES_PER_CONNECTION': '0',
+    })
+    if args.transport == 'null':
+        env['MAIL_TRANSPORT'] = 'null://'
+    return env
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def reachable(database_url):
+    from sqlalchemy import create_engine
+    try:
+        with create_engine(database_url).connect():
+            return True
+    except Exception as e:
+        print(f"Skipping {database_url.split('@')[-1]}: {e.__class__.__name__}")
+        return False
+
+def main(args):
+    workdir = tempfile.mkdtemp()
+    urls = list(args.database_url or [])
+    if not urls:
+        urls.append('sqlite:///' + os.path.join(workdir, 'bench.db'))
+        if os.environ.get('BENCH_POSTGRES_URL'):
+            urls.append(os.environ['BENCH_POSTGRES_URL'])
+
+    smtp = start_smtp_sink() if args.transport == 'smtp' else None
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {'sizes': args.sizes, 'send_size': args.send_size, 'transport': args.transport,
+                    'connections': args.connections, 'threads': args.threads},
+        'results': [],
+    }
+
+    for url in urls:
+        if not url.startswith('sqlite') and not reachable(url):
+            continue
+        dialect = url.split(':', 1)[0].split('+')[0]
+        print(f"== {dialect} ==")
+        env = child_env(args, url, tempfile.mkdtemp(dir=workdir))
+        if smtp:
+            env['MAIL_TRANSPORT'] = f'smtp://127.0.0.1:{smtp.server_address[1]}'
+        out = os.path.join(workdir, f'{dialect}.json')
+        child = [sys.executable, os.path.abspath(__file__), '--child', out,
+                 '--sizes', args.sizes, '--send-size', str(args.send_size),
+                 '--threads', str(args.threads), '--tracking-requests', str(args.tracking_requests),
+                 '--repeat', str(args.repeat)]
+        if subprocess.run(child, env=env).returncode != 0:
+            print(f"  {dialect} run failed")
+            continue
+        with open(out) as f:
+            report['results'] += [dict(r, database=dialect) for r in json.load(f)]
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"{datetime.utcnow():%Y%m%d-%H%M%S}-{commit or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+def compare(base_path, new_path, threshold):
+    """Prints every metric of two result files side by side; returns the regression count."""
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def keyed(report):
+        return {(r['database'], r['scenario'], r['size']): r for r in report['results']}
+
+    old_rows, new_rows = keyed(base), keyed(new)
+    print(f"{base.get('commit')} -> {new.get('commit')}")
+    regressions = 0
+    for key in sorted(old_rows.keys() & new_rows.keys()):
+        for metric, before in old_rows[key].items():
+            after = new_rows[key].get(metric)
+            if metric in ('database', 'scenario', 'size') or not isinstance(before, (int, float)) \
+                    or not isinstance(after, (int, float)) or not before:
+                continue
+            change = (after - before) / before
+            better = change > 0 if metric.endswith(HIGHER_IS_BETTER) else change < 0
+            judged = metric.endswith(HIGHER_IS_BETTER + LOWER_IS_BETTER)
+            flag = ''
+            if judged and abs(change) >= threshold:
+                flag = 'better' if better else 'WORSE'
+                regressions += not better
+            print(f"  {key[0]:10} {key[1]:15} {key[2]:>7}  {metric:14} {before:>12} -> {after:>12}  "
+                  f"{change:+7.1%} {flag}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000', help='recipient counts to import')
+    parser.add_argument('--send-size', type=int, default=10000, help='send the imported campaign closest to this size')
+    parser.add_argument('--transport', choices=('smtp', 'null'), default='smtp')
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='tracking client threads')
+    parser.add_argument('--tracking-requests', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20, help='samples per report page')
+    parser.add_argument('--database-url', action='append', help='repeat to run several databases')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged by --compare')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    elif args.child:
+        results = run_database(args)
+        with open(args.child, 'w') as f:
+            json.dump(results, f)
+    else:
+        main(args)
@@ -0,0 +1,157 @@
+"""
+Content-addressed attachment store.
+
+Uploaded attachments are stored once per content, under their SHA-256 in
+UPLOAD_FOLDER/blobs/ab/cd/<sha256>, so two campaigns uploading
+brochure.pdf no longer overwrite each other, and the same file uploaded
+again takes no extra space. Uploads are hashed while they are copied to
+disk in chunks; nothing holds the whole file in memory.
+
+A blob is referenced by every CampaignAttachment row with its sha256; the
+reference count is simply the number of such rows. gc() deletes blobs
+nobody references any more (after a grace period, so a blob whose row is
+still being written survives), plus legacy per-filename uploads whose
+rows are gone.
+
+    flask gc-attachments
+"""
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+
+from flask import current_app
+from sqlalchemy import func
+
+import metrics
+from models import db, CampaignAttachment
+
+CHUNK_SIZE = 1024 * 1024
+
+class BlobStore:
+    """Files on disk keyed by the SHA-256 of their content."""
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def save(self, stream, chunk_size=CHUNK_SIZE):
+        """Copies a file-like object into the store. Returns (sha256, path, size)."""
+        os.makedirs(self.tmp, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            digest = sha.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                # Already stored; touching it keeps gc() away during the grace period
+                os.utime(path)
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Atomic, so readers never see a half-written blob
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, path, size
+
+    def digests(self):
+        """Yields (sha256, path) for every stored blob."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [d for d in dirnames if d != 'tmp']
+                continue
+            for name in filenames:
+                yield name, os.path.join(dirpath, name)
+
+    def gc(self, referenced, grace=3600, now=None):
+        """
+        Deletes blobs whose sha256 is not in `referenced` and that were not
+        written or re-uploaded within `grace` seconds, and abandoned temp
+        files. Returns (files removed, bytes freed).
+        """
+        now = now or time.time()
+        removed, freed = 0, 0
+        candidates = [path for digest, path in self.digests() if digest not in referenced]
+        if os.path.isdir(self.tmp):
+            candidates += [os.path.join(self.tmp, name) for name in os.listdir(self.tmp)]
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime < grace:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += stat.st_size
+        return removed, freed
+
+def read_mapped(path):
+    """
+    Memory-maps a file for reading; the caller closes the result. Returns
+    the mmap (or b'' for an empty file, which can't be mapped).
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+_store = None
+
+def get_blob_store(config=None):
+    """Returns the process-wide store under UPLOAD_FOLDER/blobs."""
+    global _store
+    if _store is None:
+        config = config or current_app.config
+        _store = BlobStore(os.path.join(config['UPLOAD_FOLDER'], 'blobs'))
+    return _store
+
+def refcounts():
+    """{sha256: number of CampaignAttachment rows using it}."""
+    return dict(db.session.query(CampaignAttachment.sha256, func.count(CampaignAttachment.id))
+                .filter(CampaignAttachment.sha256.isnot(None))
+                .group_by(CampaignAttachment.sha256))
+
+def gc_attachments(config=None, grace=3600):
+    """
+    Deletes unreferenced blobs, and legacy uploads (files directly in
+    UPLOAD_FOLDER, from before the store) that no attachment points to,
+    once they are older than `grace` seconds. Returns (files removed, bytes freed).
+    """
+    config = config or current_app.config
+    now = time.time()
+    removed, freed = get_blob_store(config).gc(set(refcounts()), grace=grace, now=now)
+
+    folder = config['UPLOAD_FOLDER']
+    in_use = {path for path, in db.session.query(CampaignAttachment.filepath)}
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path) or path in in_use:
+            continue
+        try:
+            stat = os.stat(path)
+            if now - stat.st_mtime < grace:
+                continue
+            os.unlink(path)
+        except OSError as e:
+            metrics.error('attachments', f"Could not remove {path}: {e}")
+            continue
+        removed += 1
+        freed += stat.st_size
+    return removed, freed
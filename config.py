@@ -1,5 +1,5 @@
+import base64
 import os
-from cryptography.fernet import Fernet
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(24)
@@ -26,13 +26,141 @@ class Config:
         else:
             UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
             
+    # Explicit override (containers, benchmarks)
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or UPLOAD_FOLDER
+
     # Fix for Postgres URLs starting with postgres:// (SQLAlchemy requires postgresql://)
     if SQLALCHEMY_DATABASE_URI and SQLALCHEMY_DATABASE_URI.startswith('postgres://'):
         SQLALCHEMY_DATABASE_URI = SQLALCHEMY_DATABASE_URI.replace('postgres://', 'postgresql://', 1)
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Upgrade the schema on each process's first request. Only the default
+    # for SQLite (ephemeral on Vercel); for a server database the Procfile's
+    # release step runs `python -m migrations` once per deploy instead
+    # (elsewhere run it yourself, or set AUTO_MIGRATE=true)
+    AUTO_MIGRATE = os.environ.get(
+        'AUTO_MIGRATE', 'true' if SQLALCHEMY_DATABASE_URI.startswith('sqlite') else 'false'
+    ).lower() in ('1', 'true', 'yes')
     
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max upload size
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_UPLOAD_MB', 16)) * 1024 * 1024  # 16MB max upload size by default
+
+    # Recipient lists bigger than this are imported in the background
+    IMPORT_BACKGROUND_BYTES = int(os.environ.get('IMPORT_BACKGROUND_BYTES', 1024 * 1024))
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+    # A background import that writes no batch for this long is taken for
+    # dead (worker recycled, request timed out) and marked failed
+    IMPORT_STALE_SECONDS = int(os.environ.get('IMPORT_STALE_SECONDS', 300))
     
+    # SMTP relay (defaults to Gmail over implicit TLS)
+    SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+    SMTP_PORT = int(os.environ.get('SMTP_PORT', 465))
+    SMTP_USE_SSL = os.environ.get('SMTP_USE_SSL', 'true').lower() in ('1', 'true', 'yes')
+    # Upgrade a plain connection with STARTTLS (e.g. port 587, SMTP_USE_SSL=false)
+    SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'false').lower() in ('1', 'true', 'yes')
+    # Overrides the SMTP_* settings with a transport URL, e.g.
+    # smtp+starttls://relay:587, lmtp:///var/run/dovecot/lmtp,
+    # maildir:///tmp/outbox or null:// for load tests (see transports.py)
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT', '')
+    # Authenticated sessions kept open per campaign, and how many messages
+    # each one carries before it is closed and replaced
+    SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 1))
+    SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', 100))
+
+    # Default send limits; campaigns and sender accounts can override them.
+    # The default rate matches the old fixed 3 second delay between emails.
+    SEND_RATE_PER_SECOND = float(os.environ.get('SEND_RATE_PER_SECOND', 1 / 3))
+    SEND_BURST = int(os.environ.get('SEND_BURST', 1))
+    SEND_MAX_CONNECTIONS = int(os.environ.get('SEND_MAX_CONNECTIONS', SMTP_POOL_SIZE))
+
+    # Per recipient domain budgets inside the campaign's limits. Domains
+    # default to the campaign rate and DOMAIN_CONCURRENCY parallel sends;
+    # DOMAIN_LIMITS overrides them as "gmail.com=1.5:2,yahoo.com=0.5:1"
+    # (rate:concurrency). DOMAIN_GROUPS makes domains share a budget,
+    # e.g. "googlemail.com=gmail.com"; it is a static map, no MX lookups.
+    DOMAIN_CONCURRENCY = int(os.environ.get('DOMAIN_CONCURRENCY', 2))
+    DOMAIN_LIMITS = os.environ.get('DOMAIN_LIMITS', '')
+    DOMAIN_GROUPS = os.environ.get('DOMAIN_GROUPS', 'googlemail.com=gmail.com')
+    # A 421/450/451/452 reply halves the domain's rate and pauses it for
+    # DOMAIN_BACKOFF_SECONDS, doubling per consecutive deferral. The message
+    # is retried like any other transient failure (RETRY_* below)
+    DOMAIN_BACKOFF_SECONDS = float(os.environ.get('DOMAIN_BACKOFF_SECONDS', 30))
+    DOMAIN_MAX_BACKOFF_SECONDS = float(os.environ.get('DOMAIN_MAX_BACKOFF_SECONDS', 600))
+
+    # Upper bound on base64-encoded attachment data kept in memory per process
+    ATTACHMENT_CACHE_MAX_BYTES = int(os.environ.get('ATTACHMENT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+    # Send workers (see worker.py and the Procfile's `worker`). With
+    # SEND_INLINE_WORKER the web process also starts a thread for each
+    # campaign, for deployments that can't run `python -m worker`; it sends
+    # what is due and leaves scheduled retries for a worker, or for the next
+    # time the campaign is started.
+    SEND_INLINE_WORKER = os.environ.get('SEND_INLINE_WORKER', 'false').lower() in ('1', 'true', 'yes')
+    WORKER_BATCH_SIZE = int(os.environ.get('WORKER_BATCH_SIZE', 50))
+    WORKER_LEASE_SECONDS = int(os.environ.get('WORKER_LEASE_SECONDS', 300))
+    WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 5))
+    # Messages are rendered ahead of SMTP, at most RENDER_QUEUE_SIZE logs
+    # ahead. RENDER_PROCESSES > 0 renders in a process pool, for heavy
+    # templates on multi-core hosts.
+    RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', 200))
+    RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', 0))
+    # Send results are committed in batches of this many rows, or this often
+    RESULT_FLUSH_ROWS = int(os.environ.get('RESULT_FLUSH_ROWS', 100))
+    RESULT_FLUSH_MS = int(os.environ.get('RESULT_FLUSH_MS', 1000))
+    # Prometheus metrics: /metrics on the web app, and on this port for
+    # `python -m worker` (off when unset)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+    # cProfile these campaigns' sends ('*' for all, e.g. '12,15'); the
+    # merged profile goes to PROFILE_DIR (default: the temp dir)
+    PROFILE_CAMPAIGNS = os.environ.get('PROFILE_CAMPAIGNS', '')
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+    # Transient SMTP failures (4xx, dropped connections) are retried this
+    # many times, after base * 2^n seconds (with jitter) capped at the max
+    RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 5))
+    RETRY_BASE_SECONDS = float(os.environ.get('RETRY_BASE_SECONDS', 60))
+    RETRY_MAX_SECONDS = float(os.environ.get('RETRY_MAX_SECONDS', 3600))
+
+    # Open/click tracking is buffered in memory and written in bulk. Off by
+    # default on Vercel, where background threads don't outlive the request.
+    TRACKING_BUFFER = os.environ.get('TRACKING_BUFFER', 'false' if os.environ.get('VERCEL') else 'true').lower() in ('1', 'true', 'yes')
+    TRACKING_FLUSH_INTERVAL = float(os.environ.get('TRACKING_FLUSH_INTERVAL', 1.0))
+    TRACKING_BUFFER_MAX_EVENTS = int(os.environ.get('TRACKING_BUFFER_MAX_EVENTS', 5000))
+
+    # Campaign progress is cached per process for this many seconds; the
+    # dashboard's event stream checks it every PROGRESS_STREAM_INTERVAL and
+    # reconnects after PROGRESS_STREAM_SECONDS
+    PROGRESS_CACHE_TTL = float(os.environ.get('PROGRESS_CACHE_TTL', 1.0))
+    PROGRESS_STREAM_INTERVAL = float(os.environ.get('PROGRESS_STREAM_INTERVAL', 1.0))
+    PROGRESS_STREAM_SECONDS = int(os.environ.get('PROGRESS_STREAM_SECONDS', 60))
+    # Each open stream holds a server thread, so at most half of the web
+    # threads (WEB_THREADS, as passed to gunicorn in the Procfile) serve
+    # streams; further dashboards get a 503 and poll the ETag endpoint
+    # instead. 0: always poll
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+    PROGRESS_STREAM_MAX = int(os.environ.get('PROGRESS_STREAM_MAX', WEB_THREADS // 2))
+
+    # Campaigns per dashboard page
+    DASHBOARD_PAGE_SIZE = int(os.environ.get('DASHBOARD_PAGE_SIZE', 25))
+    # How often `python -m worker` refreshes the campaign open/click totals
+    # (without a worker, run `flask rollup-campaigns` from cron)
+    ROLLUP_INTERVAL = float(os.environ.get('ROLLUP_INTERVAL', 60))
+    # Tracking events before the last one counted that are checked again, in
+    # case they were committed late
+    ROLLUP_OVERLAP = int(os.environ.get('ROLLUP_OVERLAP', 1000))
+
+    # Delivery log rows per report page
+    REPORT_PAGE_SIZE = int(os.environ.get('REPORT_PAGE_SIZE', 100))
+    # CSV export rows fetched and written per chunk
+    EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 1000))
+
+    # Messages each sender account may send per UTC day (0: no limit);
+    # an account's own daily quota in Settings wins
+    SENDER_DAILY_QUOTA = int(os.environ.get('SENDER_DAILY_QUOTA', 0))
+
+    # Decrypted sender credentials are kept in memory for this many seconds
+    # (saving /settings refreshes them at once in that process)
+    CREDENTIAL_CACHE_TTL = float(os.environ.get('CREDENTIAL_CACHE_TTL', 300))
+
     # Encryption key for sensitive data (Settings)
-    ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or Fernet.generate_key().decode()
+    # (the fallback is what Fernet.generate_key() makes, without importing cryptography)
+    ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or base64.urlsafe_b64encode(os.urandom(32)).decode()
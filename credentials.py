@@ -0,0 +1,98 @@
+"""
+Sender credentials, served from memory.
+
+Every send, test email and settings check used to query the Settings table
+and decrypt the password again. The sender accounts are now loaded all at
+once, decrypted, and kept per process for CREDENTIAL_CACHE_TTL seconds
+(saving /settings reloads them right away in this process; other processes
+pick the change up when their copy expires). Passwords stored on a
+SendJob are decrypted once per TTL as well, instead of on every pass.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from models import Settings
+
+# A read-only copy of a Settings row with the password already decrypted.
+# The limit fields let it stand in for the row in resolve_send_limits.
+SenderAccount = namedtuple('SenderAccount', 'id email password rate_per_second burst max_connections daily_quota')
+
+def _decrypt(token):
+    # Imported here: utils pulls in smtplib and cryptography
+    from utils import decrypt_password
+    return decrypt_password(token)
+
+def _account(row):
+    try:
+        password = _decrypt(row.encrypted_password)
+    except Exception as e:
+        # e.g. ENCRYPTION_KEY changed; the address is still usable for checks
+        metrics.error('credentials', f"Decryption failed for {row.email}: {e}")
+        password = None
+    return SenderAccount(row.id, row.email, password, row.rate_per_second, row.burst, row.max_connections,
+                         row.daily_quota)
+
+class CredentialCache:
+    """Per-process cache of decrypted sender accounts with a TTL."""
+
+    MAX_SECRETS = 100
+
+    def __init__(self, ttl=300.0, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._accounts = None  # (loaded_at, [SenderAccount])
+        self._secrets = {}  # ciphertext -> (loaded_at, plaintext)
+        self.loads = 0
+        self.decrypts = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('CREDENTIAL_CACHE_TTL', 300.0)
+
+    def _fresh(self, loaded_at):
+        return self._clock() - loaded_at < self.ttl
+
+    def accounts(self):
+        """Every saved sender account, oldest first."""
+        with self._lock:
+            if self._accounts is None or not self._fresh(self._accounts[0]):
+                accounts = [_account(row) for row in Settings.query.order_by(Settings.id)]
+                self._accounts = (self._clock(), accounts)
+                self.loads += 1
+            return self._accounts[1]
+
+    def default(self):
+        """The first sender account (the one /settings edits), or None."""
+        accounts = self.accounts()
+        return accounts[0] if accounts else None
+
+    def get(self, email):
+        """The account for this sender address, or None."""
+        for account in self.accounts():
+            if account.email == email:
+                return account
+        return None
+
+    def decrypt(self, token):
+        """Decrypts a stored password, reusing the result for up to the TTL."""
+        with self._lock:
+            entry = self._secrets.get(token)
+            if entry is not None and self._fresh(entry[0]):
+                return entry[1]
+        secret = _decrypt(token)
+        with self._lock:
+            if len(self._secrets) >= self.MAX_SECRETS:
+                self._secrets.clear()
+            self._secrets[token] = (self._clock(), secret)
+            self.decrypts += 1
+        return secret
+
+    def invalidate(self):
+        """Forgets everything, e.g. after the settings were saved."""
+        with self._lock:
+            self._accounts = None
+            self._secrets.clear()
+
+credential_cache = CredentialCache()
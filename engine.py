@@ -0,0 +1,383 @@
+import heapq
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    rate: tokens added per second
+    burst: maximum tokens that can accumulate while idle
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(self.burst)
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = float(rate)
+
+    def reserve(self):
+        """Takes a token if one is available, otherwise returns the wait time."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def try_acquire(self):
+        """Non-blocking variant of acquire(). Returns True if a token was taken."""
+        return self.reserve() == 0.0
+
+    def acquire(self):
+        """Blocks until a token is available."""
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            self._sleep(wait)
+
+def resolve_send_limits(config, campaign=None, sender=None):
+    """
+    Works out the effective rate limit for a campaign.
+    App config provides the defaults; values set on the sender account or the
+    campaign override them, and when both are set the stricter one wins.
+    Returns a dict with rate (msgs/sec), burst and max_connections.
+    """
+    limits = {
+        'rate': config.get('SEND_RATE_PER_SECOND', 1 / 3),
+        'burst': config.get('SEND_BURST', 1),
+        'max_connections': config.get('SEND_MAX_CONNECTIONS', 1),
+    }
+    overrides = {}
+    for source in (sender, campaign):
+        if source is None:
+            continue
+        for key, attr in (('rate', 'rate_per_second'), ('burst', 'burst'), ('max_connections', 'max_connections')):
+            value = getattr(source, attr, None)
+            if value:
+                overrides[key] = min(overrides[key], value) if key in overrides else value
+    limits.update(overrides)
+    limits['burst'] = max(1, int(limits['burst']))
+    limits['max_connections'] = max(1, int(limits['max_connections']))
+    return limits
+
+class SendEngine:
+    """
+    Bounded worker pool that runs `send_fn` calls under a rate limit.
+    The caller submits work from a single thread and drains results back on
+    that same thread, so database sessions never cross thread boundaries.
+    """
+
+    def __init__(self, send_fn, limiter, max_workers=1, on_result=None):
+        self.send_fn = send_fn
+        self.limiter = limiter
+        # on_result(key, result) may return None to swallow a result (e.g. a
+        # send that was deferred and queued again)
+        self.on_result = on_result
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='send')
+        # Cap queued work so we never render far ahead of what can be sent
+        self._inflight = threading.BoundedSemaphore(self.max_workers * 2)
+        self._results = queue.Queue()
+
+    def _run(self, key, args, kwargs):
+        try:
+            result = self.send_fn(*args, **kwargs)
+        except Exception as e:
+            result = (False, str(e))
+        finally:
+            self._inflight.release()
+        if self.on_result:
+            result = self.on_result(key, result)
+            if result is None:
+                return
+        self._results.put((key, result))
+
+    def submit(self, key, *args, **kwargs):
+        """Queues one send, blocking while the pool is saturated or rate limited."""
+        self._inflight.acquire()
+        try:
+            self.limiter.acquire()
+            self._executor.submit(self._run, key, args, kwargs)
+        except Exception:
+            self._inflight.release()
+            raise
+
+    def drain(self):
+        """Yields (key, result) for every send that has finished so far."""
+        while True:
+            try:
+                yield self._results.get_nowait()
+            except queue.Empty:
+                return
+
+    def shutdown(self):
+        """Waits for outstanding sends and yields their results."""
+        self._executor.shutdown(wait=True)
+        yield from self.drain()
+
+# Temporary SMTP failures that mean "slow down" rather than "never"
+DEFER_CODES = {421, 450, 451, 452}
+SMTP_CODE_RE = re.compile(r'\((\d{3}),')
+
+def smtp_code(error):
+    """Pulls the SMTP reply code out of an error string, if it has one."""
+    match = SMTP_CODE_RE.search(error or '')
+    return int(match.group(1)) if match else None
+
+def recipient_domain(recipient, groups=None):
+    domain = recipient.rsplit('@', 1)[-1].strip().lower()
+    # Domains that share mail servers (e.g. googlemail.com -> gmail.com)
+    # share one budget
+    return groups.get(domain, domain) if groups else domain
+
+def parse_domain_map(text, cast=str):
+    """Parses 'a.com=x,b.com=y' config strings into a dict."""
+    result = {}
+    for entry in (text or '').split(','):
+        if '=' in entry:
+            key, value = entry.split('=', 1)
+            result[key.strip().lower()] = cast(value.strip())
+    return result
+
+def parse_domain_limit(value):
+    """'rate:concurrency' (either part optional) -> (rate, concurrency)."""
+    rate, _, concurrency = value.partition(':')
+    return (float(rate) if rate else None, int(concurrency) if concurrency else None)
+
+class _Domain:
+    def __init__(self, name, rate, concurrency, clock):
+        self.name = name
+        self.base_rate = rate
+        self.bucket = TokenBucket(rate, 1, clock=clock)
+        self.concurrency = max(1, concurrency)
+        self.queue = deque()
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.streak = 0
+        self.sent = 0
+        self.deferred = 0
+        self.failed = 0
+
+class DomainScheduler:
+    """
+    Holds pending sends grouped by recipient domain.
+
+    Every domain has its own token bucket and concurrency cap; next() walks
+    the domains round-robin and hands out work from the first one with
+    budget left, so one big or slow domain can't starve the others.
+
+    When a domain answers with a deferral (421/450/451/452) its rate is
+    halved and it pauses for an exponential backoff; the message is handed
+    back as failed, for the caller's retry schedule. Whatever that domain
+    still had queued, and whatever is added for it during the pause, is
+    not held: postponed() hands it back with the time left, so the queue
+    bound only ever applies to domains that can send and a paused domain
+    never stalls the rest. Each success gives back a tenth of the
+    configured rate.
+
+    Only domains with queued sends are walked; a domain with nothing queued,
+    nothing in flight and no backoff left to remember is dropped (keeping
+    just its counters), so a long tail of one-off domains costs nothing.
+    """
+
+    def __init__(self, rate, concurrency=2, limits=None, groups=None, backoff=30, max_backoff=600,
+                 max_queued=200, clock=time.monotonic):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.limits = limits or {}
+        self.groups = groups or {}
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_queued = max(1, max_queued)
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._domains = {}
+        self._order = []  # domains with something queued, round-robin
+        self._retired = {}  # name -> (sent, deferred, failed) of dropped domains
+        self._next = 0
+        self._queued = 0
+        self._inflight = {}  # key -> (domain, item)
+        self._postponed = []  # (key, seconds until its domain may send again)
+        self._closed = False
+        self.postponements = 0
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def _base_rate(self, name):
+        rate = self.limits.get(name, (None, None))[0]
+        return min(rate or self.rate, self.rate)
+
+    def _domain(self, name):
+        domain = self._domains.get(name)
+        if domain is None:
+            concurrency = self.limits.get(name, (None, None))[1]
+            domain = _Domain(name, self._base_rate(name), concurrency or self.concurrency, self._clock)
+            domain.sent, domain.deferred, domain.failed = self._retired.pop(name, (0, 0, 0))
+            self._domains[name] = domain
+        return domain
+
+    def _retire(self, domain):
+        """Forgets an idle domain that is back at full rate."""
+        if domain.queue or domain.inflight or domain.streak or domain.bucket.rate < domain.base_rate:
+            return
+        del self._domains[domain.name]
+        self._retired[domain.name] = (domain.sent, domain.deferred, domain.failed)
+
+    def _postpone(self, domain, key, now):
+        self._postponed.append((key, domain.paused_until - now))
+        self.postponements += 1
+
+    def add(self, key, recipient, item, timeout=None):
+        """
+        Queues one send, or postpones it straight away if its domain is
+        paused. Returns False if still full after `timeout`.
+        """
+        name = recipient_domain(recipient, self.groups)
+        with self._cond:
+            paused = self._domain(name)
+            if not self._cond.wait_for(
+                    lambda: self._queued < self.max_queued or paused.paused_until > self._clock(), timeout):
+                return False
+            # Looked up again: an idle domain may have been dropped meanwhile
+            domain = self._domain(name)
+            now = self._clock()
+            if domain.paused_until > now:
+                self._postpone(domain, key, now)
+            else:
+                if not domain.queue:
+                    self._order.append(domain)
+                domain.queue.append((key, item))
+                self._queued += 1
+                self._cond.notify_all()
+            return True
+
+    def postponed(self):
+        """Takes the [(key, seconds)] of sends handed back since the last call."""
+        with self._cond:
+            postponed, self._postponed = self._postponed, []
+            return postponed
+
+    def _unqueue(self, domain, now):
+        """Postpones everything a domain that just paused still had queued."""
+        if not domain.queue:
+            return
+        while domain.queue:
+            self._postpone(domain, domain.queue.popleft()[0], now)
+            self._queued -= 1
+        index = self._order.index(domain)
+        del self._order[index]
+        if index < self._next:
+            self._next -= 1
+        if self._next >= len(self._order):
+            self._next = 0
+
+    def _pick(self, now):
+        """Returns (domain, entry) from the next domain with budget, or (None, wait)."""
+        wait = None
+        count = len(self._order)
+        for i in range(count):
+            index = (self._next + i) % count
+            domain = self._order[index]
+            if domain.inflight >= domain.concurrency:
+                continue
+            if domain.paused_until > now:
+                delay = domain.paused_until - now
+            else:
+                delay = domain.bucket.reserve()
+                if not delay:
+                    entry = domain.queue.popleft()
+                    if domain.queue:
+                        self._next = (index + 1) % count
+                    else:
+                        # The next domain moves up into this slot
+                        del self._order[index]
+                        self._next = index % (count - 1) if count > 1 else 0
+                    return domain, entry
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def next(self, block=True):
+        """
+        Returns the next (key, item) that may be sent now. Blocks until one
+        is ready; returns None once closed and nothing is queued or in
+        flight, or straight away when block=False and nothing is ready.
+        """
+        with self._cond:
+            while True:
+                domain, entry = self._pick(self._clock())
+                if domain is not None:
+                    key, item = entry
+                    self._queued -= 1
+                    domain.inflight += 1
+                    self._inflight[key] = (domain, item)
+                    self._cond.notify_all()
+                    return key, item
+                if not block or (self._closed and not self._queued and not self._inflight):
+                    return None
+                self._cond.wait(entry)
+
+    def done(self, key, result):
+        """Records a send's outcome and returns the result."""
+        success, error = result
+        with self._cond:
+            domain, item = self._inflight.pop(key)
+            domain.inflight -= 1
+            if success:
+                domain.sent += 1
+                domain.streak = 0
+                domain.bucket.set_rate(min(domain.base_rate, domain.bucket.rate + domain.base_rate / 10))
+            elif smtp_code(error) in DEFER_CODES:
+                domain.deferred += 1
+                domain.failed += 1
+                domain.streak += 1
+                domain.bucket.set_rate(max(domain.base_rate / 64, domain.bucket.rate / 2))
+                delay = min(self.max_backoff, self.backoff * 2 ** (domain.streak - 1))
+                now = self._clock()
+                domain.paused_until = max(domain.paused_until, now + delay)
+                self._unqueue(domain, now)
+            else:
+                domain.failed += 1
+            self._retire(domain)
+            self._cond.notify_all()
+        return result
+
+    def close(self):
+        """No more add() calls; next() returns None once everything is done."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self, top=10):
+        with self._cond:
+            counts = dict(self._retired)
+            counts.update((d.name, (d.sent, d.deferred, d.failed)) for d in self._domains.values())
+            busiest = heapq.nlargest(top, counts.items(), key=lambda kv: sum(kv[1]))
+            per_domain = {}
+            for name, (sent, deferred, failed) in busiest:
+                domain = self._domains.get(name)
+                rate = domain.bucket.rate if domain else self._base_rate(name)
+                per_domain[name] = {'sent': sent, 'deferred': deferred, 'failed': failed, 'rate': round(rate, 3)}
+            return {
+                'domains': len(counts),
+                'queued': self._queued,
+                'postponed': self.postponements,
+                'per_domain': per_domain,
+            }
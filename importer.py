@@ -0,0 +1,224 @@
+"""
+Streaming recipient import.
+
+CSV files are read row by row with the csv module and Excel files with
+openpyxl's read-only mode, so an upload is never fully loaded into memory.
+Addresses are normalized and deduplicated through a set, and EmailLog rows
+are written with one executemany INSERT per batch. Column names are stored
+once per campaign (CampaignColumns) and each row keeps only its values, as
+a JSON array in the same order. Large uploads run as a
+background ImportJob whose progress can be polled; a job that stops
+reporting (its process was recycled or timed out) is marked failed by
+expire_stale_imports(), so it doesn't block the campaign forever.
+"""
+import csv
+import io
+import os
+import time
+from datetime import date, datetime, time as dt_time, timedelta
+
+from sqlalchemy import func, insert, update
+
+import metrics
+from metrics import COMMIT_SECONDS, IMPORT_ROWS_TOTAL
+from models import db, Campaign, CampaignColumns, EmailLog, ImportJob
+from progress import progress_cache
+
+def _clean_value(value):
+    """Blank cells become None and dates become strings, so rows stay JSON-safe."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value if value.strip() else None
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    return value
+
+def _iter_csv(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = next(reader, None)
+    if header is None:
+        return [], iter(())
+    columns = [str(c).strip() for c in header]
+    rows = ([_clean_value(v) for v in row] for row in reader)
+    return columns, rows
+
+def _iter_excel(stream):
+    from openpyxl import load_workbook
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    rows = workbook.worksheets[0].iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return [], iter(())
+    columns = ['' if c is None else str(c).strip() for c in header]
+    return columns, ([_clean_value(v) for v in row] for row in rows)
+
+def open_records(stream, filename):
+    """
+    Opens an uploaded CSV/Excel file for streaming.
+    Returns (email_column, columns, rows) where rows yields one list of
+    cell values per row, in `columns` order.
+    Raises ValueError for unsupported files or a missing email column.
+    """
+    filename = filename.lower()
+    if filename.endswith('.csv'):
+        columns, rows = _iter_csv(stream)
+    elif filename.endswith(('.xls', '.xlsx')):
+        columns, rows = _iter_excel(stream)
+    else:
+        raise ValueError('Invalid file type. Please upload a CSV or Excel file.')
+
+    email_col = next((col for col in columns if 'email' in col.lower()), None)
+    if not email_col:
+        raise ValueError('CSV must contain an "email" column.')
+
+    return email_col, columns, rows
+
+def parse_manual_emails(raw):
+    """Split by comma or newline, strip whitespace."""
+    if not raw:
+        return []
+    return [e.strip() for e in raw.replace('\n', ',').split(',') if e.strip()]
+
+class RecipientImporter:
+    """
+    Buffers recipients for one campaign and writes them in batches.
+    The first occurrence of an address wins; addresses are compared
+    case-insensitively after trimming whitespace.
+    """
+
+    def __init__(self, campaign_id, batch_size=1000, on_flush=None):
+        self.campaign_id = campaign_id
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.seen = set()
+        self.rows_read = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.columns = []
+        self.email_column = None
+        self._columns_saved = False
+        self._batch = []
+
+    def add(self, email, merge_values=None):
+        self.rows_read += 1
+        email = str(email).strip() if email is not None else ''
+        if not email:
+            return
+        key = email.lower()
+        if key in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(key)
+
+        self._batch.append({
+            'campaign_id': self.campaign_id,
+            'email': email,
+            'status': 'pending',
+            'merge_values': merge_values,
+        })
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def add_rows(self, email_col, columns, rows):
+        """Adds spreadsheet rows; call once, before add() for manual addresses."""
+        self.columns = list(columns)
+        self.email_column = email_col
+        email_index = self.columns.index(email_col)
+        width = len(self.columns)
+        for row in rows:
+            email = row[email_index] if email_index < len(row) else None
+            values = row[:width]
+            if email_index < len(values):
+                # The address is stored once, in EmailLog.email
+                values[email_index] = None
+            while values and values[-1] is None:
+                values.pop()
+            self.add(email, values or None)
+
+    def _save_columns(self):
+        db.session.merge(CampaignColumns(campaign_id=self.campaign_id, names=self.columns,
+                                         email_column=self.email_column))
+        self._columns_saved = True
+
+    def flush(self):
+        start = time.perf_counter()
+        rows = len(self._batch)
+        if not self._columns_saved:
+            self._save_columns()
+        if self._batch:
+            db.session.execute(insert(EmailLog), self._batch)
+            self.imported += len(self._batch)
+            self._batch = []
+        if self.on_flush:
+            self.on_flush(self)
+        db.session.commit()
+        COMMIT_SECONDS.observe(time.perf_counter() - start, kind='import')
+        IMPORT_ROWS_TOTAL.inc(rows)
+
+def _update_totals(importer, job=None):
+    db.session.execute(
+        update(Campaign)
+        .where(Campaign.id == importer.campaign_id)
+        .values(total_emails=importer.imported)
+        .execution_options(synchronize_session=False)
+    )
+    if job is not None:
+        job.rows_read = importer.rows_read
+        job.imported = importer.imported
+        job.duplicates = importer.duplicates
+        job.updated_at = datetime.utcnow()
+
+def run_import_job(app, job_id, path, manual_emails=()):
+    """Background import of a saved upload; deletes the file when done."""
+    with app.app_context():
+        job = ImportJob.query.get(job_id)
+        importer = RecipientImporter(
+            job.campaign_id,
+            batch_size=app.config.get('IMPORT_BATCH_SIZE', 1000),
+            on_flush=lambda imp: _update_totals(imp, job)
+        )
+        try:
+            with open(path, 'rb') as stream:
+                importer.add_rows(*open_records(stream, job.filename))
+            for email in manual_emails:
+                importer.add(email)
+            importer.flush()
+            job.status = 'completed'
+        except Exception as e:
+            db.session.rollback()
+            job = ImportJob.query.get(job_id)
+            job.status = 'failed'
+            job.error_message = str(e)
+            metrics.error('import', f"Import {job_id} failed: {e}")
+        finally:
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            # Progress in this process stops reporting 'importing' right away
+            progress_cache.invalidate(job.campaign_id)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def import_alive(timeout, now=None):
+    """SQL condition for imports still running: status 'running' and a batch within `timeout` seconds."""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=timeout)
+    return (ImportJob.status == 'running') & (func.coalesce(ImportJob.updated_at, ImportJob.created_at) >= cutoff)
+
+def expire_stale_imports(timeout):
+    """Marks running imports without a batch for `timeout` seconds as failed. Returns how many."""
+    now = datetime.utcnow()
+    stale = (ImportJob.status == 'running') & ~import_alive(timeout, now)
+    expired = db.session.execute(
+        update(ImportJob)
+        .where(stale)
+        .values(status='failed', finished_at=now,
+                error_message=f'Import stopped responding (no progress for {int(timeout)}s)')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if expired:
+        metrics.error('import', f"Marked {expired} stalled import(s) as failed")
+    return expired
@@ -0,0 +1,246 @@
+"""
+Hot-path instrumentation in the Prometheus text format.
+
+Counters, gauges and histograms for the send loop (SMTP connect, render,
+send, queue depth), result/tracking/import commits and errors. The web
+app serves them at /metrics; `python -m worker` serves its own on
+METRICS_PORT. Values live per process, so scrape every process. Rates
+such as emails/sec come from the counters, e.g.
+rate(neurasend_emails_total[1m]).
+
+Campaigns listed in PROFILE_CAMPAIGNS are also run under cProfile, on
+every thread of the send pipeline, and the merged profile is written to
+PROFILE_DIR (open it with `python -m pstats` or snakeviz).
+"""
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; from a fast local relay up to a slow remote SMTP login
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        yield f'{self.name}{_labels(self.labelnames, key)} {_number(value)}'
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """A value that goes up and down; or read from `function` at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception:
+                pass
+        return super().render()
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            yield f'{self.name}_bucket{_labels(self.labelnames, key, [("le", _number(bound))])} {cumulative}'
+        yield f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}'
+        yield f'{self.name}_count{_labels(self.labelnames, key)} {count}'
+
+REGISTRY = []
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+def render():
+    """All metrics of this process in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+SMTP_CONNECT_SECONDS = _register(Histogram(
+    'neurasend_smtp_connect_seconds', 'Time to open an SMTP session, including TLS and login'))
+SEND_SECONDS = _register(Histogram(
+    'neurasend_send_seconds', 'Time to hand one message to the transport', ['result']))
+RENDER_SECONDS = _register(Histogram(
+    'neurasend_render_seconds', 'Time to render and serialize one message'))
+COMMIT_SECONDS = _register(Histogram(
+    'neurasend_commit_seconds', 'Time per batched database write', ['kind']))
+SEND_QUEUE_DEPTH = _register(Gauge(
+    'neurasend_send_queue_depth', 'Leased logs waiting in the domain scheduler'))
+TRACKING_BUFFER_DEPTH = _register(Gauge(
+    'neurasend_tracking_buffer_depth', 'Tracking events waiting to be written'))
+EMAILS_TOTAL = _register(Counter(
+    'neurasend_emails_total', 'Send results written to the database', ['status']))
+TRACKING_EVENTS_TOTAL = _register(Counter(
+    'neurasend_tracking_events_total', 'Open and click hits received', ['kind']))
+IMPORT_ROWS_TOTAL = _register(Counter(
+    'neurasend_import_rows_total', 'Recipients imported'))
+ERRORS_TOTAL = _register(Counter(
+    'neurasend_errors_total', 'Errors caught and logged', ['where']))
+
+def error(where, message):
+    """Logs an error the way the app always has, and counts it."""
+    ERRORS_TOTAL.inc(where=where)
+    print(message)
+
+def metrics_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+    return [render().encode('utf-8')]
+
+def start_http_server(port, host='0.0.0.0'):
+    """Serves /metrics from a daemon thread (for processes without Flask routes)."""
+    from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = make_server(host, port, metrics_app, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+class Profiler:
+    """
+    Collects cProfile data from several threads into one profile. Each
+    thread gets its own cProfile.Profile the first time it runs code
+    under running() or a wrap()ped function.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiles = []
+
+    @contextlib.contextmanager
+    def running(self):
+        import cProfile
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            # Only one profiler may run at a time on Python 3.12+
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def wrap(self, fn):
+        def profiled(*args, **kwargs):
+            with self.running():
+                return fn(*args, **kwargs)
+        return profiled
+
+    def dump(self, path, top=25):
+        """Writes the merged profile to `path`; returns the top entries as text."""
+        with self._lock:
+            profiles = [p for p in self._profiles if p.getstats()]
+        if not profiles:
+            return ''
+        import pstats
+        out = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=out)
+        stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(top)
+        return out.getvalue()
+
+def campaign_profiler(config, campaign_id):
+    """A Profiler if PROFILE_CAMPAIGNS lists this campaign ('*' for all), else None."""
+    selected = {s.strip() for s in (config.get('PROFILE_CAMPAIGNS') or '').split(',') if s.strip()}
+    if '*' in selected or str(campaign_id) in selected:
+        return Profiler()
+    return None
+
+def profile_path(config, campaign_id):
+    directory = config.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'neurasend-profiles')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"campaign-{campaign_id}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
@@ -0,0 +1,205 @@
+"""
+Schema migrations.
+
+    python -m migrations
+
+Tables that don't exist yet are created from the models. Changes to
+existing tables are listed in MIGRATIONS, in order, and applied once each;
+the applied versions are recorded in the schema_version table. Every step
+checks the live schema first, so it is harmless on a database that already
+has the change (a fresh create_all, or one patched by the old
+check_schema.py script).
+
+Runs as the Procfile release step, and with AUTO_MIGRATE (the default
+only for SQLite) on the first request of each process (see init_app) and
+at worker startup. On Postgres,
+concurrent runs are serialized with an advisory lock and indexes are built
+CONCURRENTLY so sends and tracking keep working on a live table.
+"""
+import threading
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.exc import IntegrityError
+
+from models import db
+
+metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+# Arbitrary key for pg_advisory_lock
+LOCK_ID = 7146205
+
+def _columns(conn, table):
+    return {col['name'] for col in inspect(conn).get_columns(table)}
+
+def add_column(conn, table, name, type_, default=None):
+    if name in _columns(conn, table):
+        return
+    ddl = type_.compile(dialect=conn.dialect)
+    if default is not None:
+        # Fills existing rows too
+        ddl += f' NOT NULL DEFAULT {default}'
+    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}'))
+
+def create_index(conn, name, table, columns):
+    if any(ix['name'] == name for ix in inspect(conn).get_indexes(table)):
+        return
+    cols = ', '.join(columns)
+    if conn.dialect.name == 'postgresql':
+        # CONCURRENTLY can't run inside a transaction block, and waits for
+        # every older transaction to finish, including our own
+        conn.commit()
+        with conn.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as ddl_conn:
+            ddl_conn.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({cols})'))
+    else:
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})'))
+
+def _tracking_columns(conn):
+    add_column(conn, 'email_log', 'opened_at', db.DateTime())
+    add_column(conn, 'email_log', 'clicked_at', db.DateTime())
+    add_column(conn, 'email_log', 'links_clicked', db.JSON())
+
+def _send_limits(conn):
+    for table in ('campaign', 'settings'):
+        add_column(conn, table, 'rate_per_second', db.Float())
+        add_column(conn, table, 'burst', db.Integer())
+        add_column(conn, table, 'max_connections', db.Integer())
+
+def _worker_leases(conn):
+    add_column(conn, 'email_log', 'lease_owner', db.String(64))
+    add_column(conn, 'email_log', 'lease_expires_at', db.DateTime())
+
+def _email_log_indexes(conn):
+    create_index(conn, 'ix_email_log_campaign_id', 'email_log', ['campaign_id', 'id'])
+    create_index(conn, 'ix_email_log_campaign_status', 'email_log', ['campaign_id', 'status', 'id'])
+    create_index(conn, 'ix_email_log_campaign_opened', 'email_log', ['campaign_id', 'opened_at'])
+    create_index(conn, 'ix_email_log_campaign_clicked', 'email_log', ['campaign_id', 'clicked_at'])
+
+def _campaign_rollup(conn):
+    add_column(conn, 'campaign', 'open_count', db.Integer())
+    add_column(conn, 'campaign', 'click_count', db.Integer())
+    add_column(conn, 'campaign', 'rollup_event_id', db.Integer())
+    add_column(conn, 'campaign', 'rollup_at', db.DateTime())
+    create_index(conn, 'ix_campaign_created', 'campaign', ['created_at', 'id'])
+
+def _email_log_retries(conn):
+    add_column(conn, 'email_log', 'retry_count', db.Integer(), default=0)
+    add_column(conn, 'email_log', 'next_attempt_at', db.DateTime())
+    create_index(conn, 'ix_email_log_campaign_retry', 'email_log', ['campaign_id', 'status', 'next_attempt_at'])
+
+def _merge_values(conn):
+    # campaign_columns itself is new, so create_all has made it already
+    add_column(conn, 'email_log', 'merge_values', db.JSON())
+
+def _sender_pool(conn):
+    add_column(conn, 'settings', 'daily_quota', db.Integer())
+    add_column(conn, 'settings', 'sent_today', db.Integer())
+    add_column(conn, 'settings', 'quota_date', db.Date())
+    add_column(conn, 'settings', 'status', db.String(20))
+    add_column(conn, 'settings', 'paused_until', db.DateTime())
+    add_column(conn, 'settings', 'last_error', db.Text())
+
+def _attachment_blobs(conn):
+    add_column(conn, 'campaign_attachment', 'sha256', db.String(64))
+    add_column(conn, 'campaign_attachment', 'size', db.BigInteger())
+    create_index(conn, 'ix_campaign_attachment_sha256', 'campaign_attachment', ['sha256'])
+
+def _scrub_job_credentials(conn):
+    # Completed jobs no longer need the credentials they were sent with
+    conn.execute(text("UPDATE send_job SET sender_email = NULL, encrypted_password = NULL "
+                      "WHERE status = 'completed'"))
+
+def _import_heartbeat(conn):
+    add_column(conn, 'import_job', 'updated_at', db.DateTime())
+
+# (version, description, step). Append only; never renumber or edit an
+# applied step, add a new one instead.
+MIGRATIONS = [
+    (1, 'Open/click tracking columns on email_log', _tracking_columns),
+    (2, 'Send limits on campaign and settings', _send_limits),
+    (3, 'Worker lease columns on email_log', _worker_leases),
+    (4, 'Composite indexes for email_log hot queries', _email_log_indexes),
+    (5, 'Engagement rollup columns and listing index on campaign', _campaign_rollup),
+    (6, 'Retry scheduling on email_log', _email_log_retries),
+    (7, 'Positional merge values on email_log', _merge_values),
+    (8, 'Quota and health columns for sender accounts', _sender_pool),
+    (9, 'Content addresses on campaign_attachment', _attachment_blobs),
+    (10, 'Clear credentials from completed send jobs', _scrub_job_credentials),
+    (11, 'Heartbeat on import_job', _import_heartbeat),
+]
+
+def _applied(conn):
+    return {row.version for row in conn.execute(select(schema_version.c.version))}
+
+def upgrade(engine=None):
+    """Brings the database up to date. Returns the versions applied."""
+    engine = engine or db.engine
+    applied = []
+    with engine.connect() as conn:
+        postgres = conn.dialect.name == 'postgresql'
+        if postgres:
+            conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': LOCK_ID})
+            conn.commit()
+        try:
+            db.metadata.create_all(conn)
+            metadata.create_all(conn)
+            done = _applied(conn)
+            conn.commit()
+            for version, description, step in MIGRATIONS:
+                if version in done:
+                    continue
+                step(conn)
+                try:
+                    conn.execute(schema_version.insert().values(
+                        version=version, description=description, applied_at=datetime.utcnow()))
+                    conn.commit()
+                except IntegrityError:
+                    # Another process got there first
+                    conn.rollback()
+                    continue
+                applied.append(version)
+                print(f"Applied migration {version}: {description}")
+        finally:
+            if postgres:
+                conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': LOCK_ID})
+                conn.commit()
+    return applied
+
+def init_app(app):
+    """
+    Upgrades the schema before the first request this process serves,
+    unless AUTO_MIGRATE is off (e.g. when a release step already ran it).
+    """
+    if not app.config.get('AUTO_MIGRATE', True):
+        return
+    lock = threading.Lock()
+    done = []
+
+    @app.before_request
+    def _upgrade_schema_once():
+        if done:
+            return
+        with lock:
+            if not done:
+                upgrade()
+                done.append(True)
+
+def current_version(engine=None):
+    with (engine or db.engine).connect() as conn:
+        return conn.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc())).scalar()
+
+def main():
+    from app import app
+    with app.app_context():
+        upgrade()
+        print(f"Database schema at version {current_version()}")
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,26 @@ class Settings(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     encrypted_password = db.Column(db.String(500), nullable=False)
 
+    # Optional per-sender send limits (fall back to app config when unset)
+    rate_per_second = db.Column(db.Float, nullable=True)
+    burst = db.Column(db.Integer, nullable=True)
+    max_connections = db.Column(db.Integer, nullable=True)
+
+    # Sender pool: messages per UTC day (SENDER_DAILY_QUOTA when unset),
+    # today's count, and health ('active', 'paused' until paused_until
+    # after a quota error, or 'disabled' after a login failure)
+    daily_quota = db.Column(db.Integer, nullable=True)
+    sent_today = db.Column(db.Integer, nullable=True)
+    quota_date = db.Column(db.Date, nullable=True)
+    status = db.Column(db.String(20), default='active')
+    paused_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
 class Campaign(db.Model):
+    __table_args__ = (
+        db.Index('ix_campaign_created', 'created_at', 'id'), # dashboard pages
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(200), nullable=False)
     content_html = db.Column(db.Text, nullable=False)
@@ -16,6 +35,18 @@ class Campaign(db.Model):
     sent_count = db.Column(db.Integer, default=0)
     failed_count = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Optional per-campaign send limits (stricter of campaign/sender wins)
+    rate_per_second = db.Column(db.Float, nullable=True)
+    burst = db.Column(db.Integer, nullable=True)
+    max_connections = db.Column(db.Integer, nullable=True)
+
+    # Unique opens/clicks, precomputed by rollup_engagement() so listings
+    # never scan email_log
+    open_count = db.Column(db.Integer, default=0)
+    click_count = db.Column(db.Integer, default=0)
+    rollup_event_id = db.Column(db.Integer, nullable=True) # last tracking_event included
+    rollup_at = db.Column(db.DateTime, nullable=True)
     
     # Relationships
     logs = db.relationship('EmailLog', backref='campaign', lazy=True)
@@ -26,18 +57,92 @@ class CampaignAttachment(db.Model):
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     filepath = db.Column(db.String(500), nullable=False)
+    # Content address in the blob store (see blobs.py); None for uploads
+    # from before it, which live at UPLOAD_FOLDER/<filename>
+    sha256 = db.Column(db.String(64), nullable=True, index=True)
+    size = db.Column(db.BigInteger, nullable=True)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class EmailLog(db.Model):
+    # Every hot query filters by campaign first. Existing databases get
+    # these from migrations.py, which must be kept in step.
+    __table_args__ = (
+        db.Index('ix_email_log_campaign_id', 'campaign_id', 'id'), # report, export
+        db.Index('ix_email_log_campaign_status', 'campaign_id', 'status', 'id'), # pending batches, status counts
+        db.Index('ix_email_log_campaign_opened', 'campaign_id', 'opened_at'),
+        db.Index('ix_email_log_campaign_clicked', 'campaign_id', 'clicked_at'),
+        db.Index('ix_email_log_campaign_retry', 'campaign_id', 'status', 'next_attempt_at'), # due retries
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
     email = db.Column(db.String(120), nullable=False)
-    status = db.Column(db.String(20), nullable=False) # 'success', 'failed'
+    status = db.Column(db.String(20), nullable=False) # 'pending', 'sent', 'failed', 'retry'
     error_message = db.Column(db.Text, nullable=True)
-    merge_data = db.Column(db.JSON, nullable=True) # Stores personalization data (e.g. {'name': 'John'})
+    merge_data = db.Column(db.JSON, nullable=True) # Legacy per-row {'name': 'John'}; see merge_values
+    # Personalization values in CampaignColumns.names order (e.g. ['John', 'Acme']);
+    # the address itself is only kept in `email`
+    merge_values = db.Column(db.JSON, nullable=True)
     sent_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Tracking
     opened_at = db.Column(db.DateTime, nullable=True)
     clicked_at = db.Column(db.DateTime, nullable=True)
-    links_clicked = db.Column(db.JSON, nullable=True) # Store list of clicked URLs
+    links_clicked = db.Column(db.JSON, nullable=True) # Legacy click history, moved to TrackingEvent
+
+    # Worker lease (see worker.py); expired leases can be reclaimed
+    lease_owner = db.Column(db.String(64), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+
+    # Transient failures are retried with backoff (status 'retry')
+    retry_count = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+
+class CampaignColumns(db.Model):
+    """Column names of a campaign's recipient list, stored once for all its EmailLog rows."""
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), primary_key=True)
+    names = db.Column(db.JSON, nullable=False) # e.g. ['Email', 'name', 'company']
+    email_column = db.Column(db.String(255), nullable=True) # its values are EmailLog.email
+
+class TrackingEvent(db.Model):
+    """Append-only open/click event, written by the tracking flusher."""
+    __table_args__ = (
+        db.Index('ix_tracking_event_campaign_kind_ts', 'campaign_id', 'kind', 'ts'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    log_id = db.Column(db.Integer, db.ForeignKey('email_log.id'), nullable=False, index=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False) # 'open', 'click'
+    url_hash = db.Column(db.String(40), nullable=True) # sha1 of url, for grouping clicks by link
+    url = db.Column(db.Text, nullable=True)
+    ts = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SendJob(db.Model):
+    """A queued campaign send, picked up by worker processes."""
+    id = db.Column(db.Integer, primary_key=True)
+    # Unique so the same campaign can't be started twice
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), unique=True, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued') # 'queued', 'running', 'completed'
+    base_url = db.Column(db.String(500), nullable=False)
+    # Credentials submitted with the send request (password encrypted)
+    sender_email = db.Column(db.String(120), nullable=True)
+    encrypted_password = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+
+class ImportJob(db.Model):
+    """Background recipient import for a large upload (see importer.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='running') # 'running', 'completed', 'failed'
+    rows_read = db.Column(db.Integer, default=0)
+    imported = db.Column(db.Integer, default=0)
+    duplicates = db.Column(db.Integer, default=0)
+    error_message = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow) # touched every batch
+    finished_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,224 @@
+"""
+Send pipeline.
+
+    fetch (caller thread) -> render -> transmit
+
+The caller leases pending logs and feeds them into a DomainScheduler,
+which queues them per recipient domain. A render thread takes whatever the
+scheduler says may go out next, turns it into a fully serialized message
+(optionally fanning the work out to a process pool for CPU-heavy
+templates) and hands it to the send engine, whose workers transmit it.
+The stages overlap, so rendering the next messages happens while earlier
+ones wait on SMTP.
+
+Back-pressure comes from the bounds: the scheduler holds at most
+`max_queued` logs, and the send engine only takes a couple of messages
+per connection ahead of what is being sent. Logs for a domain that is
+backing off are not held at all; postponed() hands them back to the
+caller.
+"""
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from engine import SendEngine
+from metrics import RENDER_SECONDS
+from utils import build_message
+
+class StageTimer:
+    """Counts items through one stage, time spent working and time spent blocked."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    def record(self, busy=0.0, items=1, waiting=0.0):
+        with self._lock:
+            self.items += items
+            self.busy += busy
+            self.waiting += waiting
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': self.items,
+                'busy_s': round(self.busy, 3),
+                'wait_s': round(self.waiting, 3),
+                'avg_ms': round(1000 * self.busy / self.items, 3) if self.items else 0.0,
+            }
+
+def render_message(context, item):
+    """
+    Renders one leased log into a serialized message.
+    context: (template, base_url, sender_email, attachments)
+    item: (log_id, recipient, merge_data)
+    Returns (log_id, recipient, message, error); message is None on error.
+    Without a sender_email the message is returned unserialized, for the
+    sender to set From on (see senders.SenderPool.transmit).
+    """
+    template, base_url, sender_email, attachments = context
+    log_id, recipient, merge_data = item
+    try:
+        # Personalization, open pixel and click tracking in one pass
+        subject, html = template.render(merge_data, log_id, base_url)
+        message = build_message(sender_email, recipient, subject, html, attachments)
+        if sender_email:
+            message = message.as_string()
+        return log_id, recipient, message, None
+    except Exception as e:
+        return log_id, recipient, None, f"Render failed: {e}"
+
+# Set once per render process so the template isn't pickled per message
+_process_context = None
+
+def _init_render_process(context):
+    global _process_context
+    _process_context = context
+
+def _render_in_process(item):
+    return render_message(_process_context, item)
+
+class SendPipeline:
+    """
+    Renders and transmits messages on background threads.
+    transmit_fn(recipient, message) -> (ok, error) runs on the send
+    engine's workers under `limiter`, in the order `scheduler` allows.
+    Results come back on the caller's thread through results()/close(),
+    keyed by log id; deferred sends are retried inside the scheduler and
+    only their final result is reported. With a metrics.Profiler, the
+    render thread runs under it (wrap transmit_fn for the send threads).
+    """
+
+    def __init__(self, context, transmit_fn, limiter, scheduler, max_workers=1, processes=0, profiler=None,
+                 clock=time.perf_counter):
+        self.context = context
+        self.transmit_fn = transmit_fn
+        self.scheduler = scheduler
+        self._clock = clock
+        self._errors = queue.Queue()
+        self.fetch = StageTimer()
+        self.render = StageTimer()
+        self.transmit = StageTimer()
+
+        self.engine = SendEngine(self._transmit, limiter, max_workers=max_workers, on_result=scheduler.done)
+
+        self.processes = processes
+        self._process_pool = None
+        if processes:
+            # spawn: never fork a process that holds DB connections and threads
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_render_process,
+                initargs=(context,)
+            )
+        render_loop = profiler.wrap(self._render_loop) if profiler else self._render_loop
+        self._thread = threading.Thread(target=render_loop, name='render', daemon=True)
+        self._thread.start()
+
+    def _transmit(self, recipient, message):
+        start = self._clock()
+        try:
+            return self.transmit_fn(recipient, message)
+        finally:
+            self.transmit.record(self._clock() - start)
+
+    def _take_batch(self):
+        """Blocks for one sendable item, then takes what else is ready (up to a chunk)."""
+        start = self._clock()
+        first = self.scheduler.next()
+        waited = self._clock() - start
+        if first is None:
+            return None, waited
+        items = [first]
+        # Chunks only pay off when they are spread over processes
+        limit = self.processes * 8 if self.processes else 1
+        while len(items) < limit:
+            entry = self.scheduler.next(block=False)
+            if entry is None:
+                break
+            items.append(entry)
+        return [item for _, item in items], waited
+
+    def _render_loop(self):
+        while True:
+            items, waited = self._take_batch()
+            if items is None:
+                return
+
+            start = self._clock()
+            try:
+                if self._process_pool:
+                    rendered = list(self._process_pool.map(_render_in_process, items, chunksize=8))
+                else:
+                    rendered = [render_message(self.context, item) for item in items]
+            except Exception as e:
+                # A broken process pool fails the whole chunk
+                rendered = [(item[0], item[1], None, f"Render failed: {e}") for item in items]
+            elapsed = self._clock() - start
+            self.render.record(elapsed, items=len(items), waiting=waited)
+            for _ in items:
+                RENDER_SECONDS.observe(elapsed / len(items))
+
+            for log_id, recipient, message, error in rendered:
+                if error:
+                    self._errors.put((log_id, self.scheduler.done(log_id, (False, error))))
+                    continue
+                start = self._clock()
+                # Blocks while the engine is saturated or rate limited
+                self.engine.submit(log_id, recipient, message)
+                self.render.record(waiting=self._clock() - start, items=0)
+
+    def put(self, item, on_wait=None):
+        """
+        Feeds one (log_id, recipient, merge_data) into the pipeline.
+        Blocks while the scheduler is full, calling on_wait() meanwhile
+        so the caller can keep handling results.
+        """
+        start = self._clock()
+        log_id, recipient, _ = item
+        while not self.scheduler.add(log_id, recipient, item, timeout=0.05):
+            if on_wait:
+                on_wait()
+        self.fetch.record(waiting=self._clock() - start, items=0)
+
+    def results(self):
+        """Yields (log_id, result) for every message finished so far."""
+        while True:
+            try:
+                yield self._errors.get_nowait()
+            except queue.Empty:
+                break
+        yield from self.engine.drain()
+
+    def postponed(self):
+        """(log_id, seconds) for logs handed back unsent because their domain is backing off."""
+        return self.scheduler.postponed()
+
+    def close(self, on_wait=None):
+        """
+        Waits for everything queued to be sent and yields the remaining
+        results; check postponed() afterwards. on_wait() is called while waiting.
+        """
+        self.scheduler.close()
+        while self._thread.is_alive():
+            self._thread.join(0.1)
+            if on_wait:
+                on_wait()
+        if self._process_pool:
+            self._process_pool.shutdown()
+        yield from self.engine.shutdown()
+        yield from self.results()
+
+    def stats(self):
+        return {
+            'fetch': self.fetch.stats(),
+            'render': self.render.stats(),
+            'transmit': self.transmit.stats(),
+            'render_processes': self.processes,
+            'scheduler': self.scheduler.stats(),
+        }
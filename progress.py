@@ -0,0 +1,122 @@
+"""
+Campaign progress, served from memory.
+
+Dashboards ask for progress far more often than it changes, so counters
+are cached per process and reloaded from the database at most once per
+PROGRESS_CACHE_TTL, with one query for every stale campaign at once. The
+shared source of truth is the sent/failed counters that ResultFlusher
+increments on the campaign row in the same transaction as the results;
+there is no cross-process push. Sends made by this process (the inline
+worker) also update its cache as soon as they are committed; sends from
+`python -m worker` processes show up on the next reload.
+"""
+import threading
+import time
+
+from sqlalchemy import func
+
+from models import db, Campaign, EmailLog, ImportJob, SendJob
+
+def _progress(total, sent, failed, retrying=0, importing=False):
+    total, sent, failed = total or 0, sent or 0, failed or 0
+    if importing:
+        # Recipients are still arriving; total is what has been imported so far
+        status = 'importing'
+    else:
+        status = 'completed' if (sent + failed) >= total else 'processing'
+    return {
+        'total': total,
+        'sent': sent,
+        'failed': failed,
+        'retrying': retrying,
+        'status': status
+    }
+
+def progress_etag(campaign_id, progress):
+    return (f"{campaign_id}-{progress['total']}-{progress['sent']}-{progress['failed']}"
+            f"-{progress.get('retrying', 0)}-{progress['status']}")
+
+class ProgressCache:
+    """Per-process cache of campaign counters with a short TTL."""
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self, ttl=1.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.import_timeout = 300
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}  # campaign_id -> (loaded_at, progress)
+        self._active = (None, [])
+        self.queries = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('PROGRESS_CACHE_TTL', 1.0)
+        self.import_timeout = app.config.get('IMPORT_STALE_SECONDS', 300)
+
+    def get_many(self, campaign_ids):
+        """Progress for each known campaign id; unknown ids are left out."""
+        now = self._clock()
+        with self._lock:
+            stale = [cid for cid in campaign_ids
+                     if cid not in self._entries or now - self._entries[cid][0] >= self.ttl]
+            if stale:
+                # Held during the query so concurrent readers share one reload
+                rows = (db.session.query(Campaign.id, Campaign.total_emails,
+                                         Campaign.sent_count, Campaign.failed_count)
+                        .filter(Campaign.id.in_(stale))
+                        .all())
+                retrying = dict(db.session.query(EmailLog.campaign_id, func.count(EmailLog.id))
+                                .filter(EmailLog.campaign_id.in_(stale), EmailLog.status == 'retry')
+                                .group_by(EmailLog.campaign_id)
+                                .all())
+                # Imported here: importer imports this module
+                from importer import import_alive
+                importing = {row.campaign_id for row in db.session.query(ImportJob.campaign_id)
+                             .filter(ImportJob.campaign_id.in_(stale), import_alive(self.import_timeout))}
+                self.queries += 3
+                for stale_id in stale:
+                    self._entries.pop(stale_id, None)
+                for cid, total, sent, failed in rows:
+                    self._entries[cid] = (now, _progress(total, sent, failed, retrying.get(cid, 0),
+                                                         cid in importing))
+                self._prune(now)
+            return {cid: dict(self._entries[cid][1]) for cid in campaign_ids if cid in self._entries}
+
+    def get(self, campaign_id):
+        return self.get_many([campaign_id]).get(campaign_id)
+
+    def active_ids(self):
+        """Ids of campaigns with a queued or running send job."""
+        now = self._clock()
+        with self._lock:
+            loaded_at, ids = self._active
+            if loaded_at is None or now - loaded_at >= self.ttl:
+                ids = [row.campaign_id for row in db.session.query(SendJob.campaign_id)
+                       .filter(SendJob.status.in_(('queued', 'running')))]
+                self.queries += 1
+                self._active = (now, ids)
+            return list(ids)
+
+    def apply(self, campaign_id, sent=0, failed=0):
+        """Adds freshly committed results to a cached entry, if there is one."""
+        with self._lock:
+            entry = self._entries.get(campaign_id)
+            if entry:
+                p = entry[1]
+                self._entries[campaign_id] = (entry[0], _progress(p['total'], p['sent'] + sent, p['failed'] + failed,
+                                                                  p['retrying'], p['status'] == 'importing'))
+
+    def invalidate(self, campaign_id=None):
+        with self._lock:
+            if campaign_id is None:
+                self._entries.clear()
+                self._active = (None, [])
+            else:
+                self._entries.pop(campaign_id, None)
+
+    def _prune(self, now):
+        if len(self._entries) > self.MAX_ENTRIES:
+            self._entries = {cid: e for cid, e in self._entries.items() if now - e[0] < self.ttl}
+
+progress_cache = ProgressCache()
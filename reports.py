@@ -0,0 +1,256 @@
+"""
+Campaign report and dashboard queries.
+
+Headline numbers are computed with one GROUP BY in the database and the
+delivery log is paged by id (keyset pagination), loading only the columns
+the page shows, so a report costs the same whatever the campaign size.
+The CSV export streams rows straight from a server-side cursor. The
+dashboard pages through campaigns the same way and reads open/click totals
+that rollup_engagement() stores on the campaign rows; `python -m worker`
+runs it every ROLLUP_INTERVAL seconds, and `flask rollup-campaigns` can
+run it from cron where there is no worker.
+"""
+import csv
+import io
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam, func, or_, select, update
+from sqlalchemy.orm import load_only
+
+import metrics
+from models import db, Campaign, EmailLog, TrackingEvent
+
+# Columns the delivery log shows; merge_data and the rest stay in the database
+LOG_COLUMNS = (EmailLog.id, EmailLog.email, EmailLog.status, EmailLog.error_message,
+               EmailLog.sent_at, EmailLog.opened_at, EmailLog.clicked_at,
+               EmailLog.retry_count, EmailLog.next_attempt_at)
+
+# Filters offered on the report page
+STATUS_FILTERS = ('sent', 'failed', 'pending', 'retry', 'opened', 'clicked')
+
+def campaign_stats(campaign_id):
+    """Counts per status plus opens/clicks, from a single aggregate query."""
+    rows = (db.session.query(EmailLog.status,
+                             func.count(EmailLog.id),
+                             func.count(EmailLog.opened_at),
+                             func.count(EmailLog.clicked_at))
+            .filter(EmailLog.campaign_id == campaign_id)
+            .group_by(EmailLog.status)
+            .all())
+
+    stats = {'total': 0, 'sent': 0, 'failed': 0, 'pending': 0, 'retry': 0, 'opened': 0, 'clicked': 0}
+    for status, count, opened, clicked in rows:
+        stats['total'] += count
+        if status in stats:
+            stats[status] += count
+        stats['opened'] += opened
+        stats['clicked'] += clicked
+
+    stats['open_rate'] = round(100 * stats['opened'] / stats['sent'], 1) if stats['sent'] else 0.0
+    stats['click_rate'] = round(100 * stats['clicked'] / stats['sent'], 1) if stats['sent'] else 0.0
+    return stats
+
+def _filtered(campaign_id, status):
+    query = (EmailLog.query
+             .options(load_only(*LOG_COLUMNS))
+             .filter(EmailLog.campaign_id == campaign_id))
+    if status == 'opened':
+        query = query.filter(EmailLog.opened_at.isnot(None))
+    elif status == 'clicked':
+        query = query.filter(EmailLog.clicked_at.isnot(None))
+    elif status:
+        query = query.filter(EmailLog.status == status)
+    return query
+
+def log_page(campaign_id, status=None, after=None, before=None, size=100):
+    """
+    One page of a campaign's delivery log, ordered by id.
+    Pass `after` (last id of the current page) for the next page or
+    `before` (its first id) for the previous one.
+    Returns (logs, prev_before, next_after); the cursors are None at either end.
+    """
+    query = _filtered(campaign_id, status)
+    if before is not None:
+        logs = (query.filter(EmailLog.id < before)
+                .order_by(EmailLog.id.desc())
+                .limit(size + 1)
+                .all())
+        has_prev = len(logs) > size
+        logs = logs[:size][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(EmailLog.id > after)
+        logs = query.order_by(EmailLog.id).limit(size + 1).all()
+        has_next = len(logs) > size
+        logs = logs[:size]
+        has_prev = after is not None
+
+    prev_before = logs[0].id if logs and has_prev else None
+    next_after = logs[-1].id if logs and has_next else None
+    return logs, prev_before, next_after
+
+def _campaign_cursor(campaign):
+    return f"{campaign.created_at.isoformat()}_{campaign.id}"
+
+def parse_campaign_cursor(value):
+    """Parses a dashboard page cursor; returns (created_at, id) or None."""
+    try:
+        created_at, campaign_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(campaign_id)
+    except (AttributeError, ValueError):
+        return None
+
+def campaign_page(search=None, since=None, until=None, older=None, newer=None, size=25):
+    """
+    One page of campaigns, newest first, keyset-paginated on (created_at, id).
+    `search` matches the subject, `since`/`until` are inclusive dates.
+    Pass `older` (the cursor of the page's last row) for the next page or
+    `newer` (its first row) for the previous one.
+    Returns (campaigns, newer_cursor, older_cursor); None at either end.
+    """
+    query = Campaign.query
+    if search:
+        query = query.filter(Campaign.subject.icontains(search, autoescape=True))
+    if since:
+        query = query.filter(Campaign.created_at >= since)
+    if until:
+        query = query.filter(Campaign.created_at < until + timedelta(days=1))
+
+    if newer:
+        ts, cid = newer
+        campaigns = (query.filter(or_(Campaign.created_at > ts, and_(Campaign.created_at == ts, Campaign.id > cid)))
+                     .order_by(Campaign.created_at, Campaign.id)
+                     .limit(size + 1)
+                     .all())
+        has_newer = len(campaigns) > size
+        campaigns = campaigns[:size][::-1]
+        has_older = True
+    else:
+        if older:
+            ts, cid = older
+            query = query.filter(or_(Campaign.created_at < ts, and_(Campaign.created_at == ts, Campaign.id < cid)))
+        campaigns = query.order_by(Campaign.created_at.desc(), Campaign.id.desc()).limit(size + 1).all()
+        has_older = len(campaigns) > size
+        campaigns = campaigns[:size]
+        has_newer = older is not None
+
+    newer_cursor = _campaign_cursor(campaigns[0]) if campaigns and has_newer else None
+    older_cursor = _campaign_cursor(campaigns[-1]) if campaigns and has_older else None
+    return campaigns, newer_cursor, older_cursor
+
+def campaign_totals():
+    """(campaigns, emails sent) across all campaigns, from the campaign table only."""
+    count, sent = db.session.query(func.count(Campaign.id), func.sum(Campaign.sent_count)).one()
+    return count, sent or 0
+
+def rollup_engagement(full=False, chunk=500, overlap=1000):
+    """
+    Stores unique open/click totals on each campaign row.
+    Only campaigns with tracking events since the last run are recounted
+    (the last event id included is kept on the campaign), or every
+    campaign with full=True. Campaigns among the `overlap` events before
+    that are recounted too: ids are handed out before commit, so a slow
+    flush can land below events an earlier run already counted.
+    Returns the number of campaigns updated.
+    """
+    latest = db.session.query(func.max(TrackingEvent.id)).scalar()
+    if full:
+        campaign_ids = [cid for (cid,) in db.session.query(Campaign.id)]
+    else:
+        if latest is None:
+            return 0
+        watermark = db.session.query(func.max(Campaign.rollup_event_id)).scalar() or 0
+        campaign_ids = [cid for (cid,) in db.session.query(TrackingEvent.campaign_id)
+                        .filter(TrackingEvent.id > watermark - overlap, TrackingEvent.id <= latest)
+                        .distinct()]
+
+    now = datetime.utcnow()
+    table = Campaign.__table__
+    for start in range(0, len(campaign_ids), chunk):
+        ids = campaign_ids[start:start + chunk]
+        counts = {cid: (opened, clicked) for cid, opened, clicked in
+                  db.session.query(EmailLog.campaign_id,
+                                   func.count(EmailLog.opened_at),
+                                   func.count(EmailLog.clicked_at))
+                  .filter(EmailLog.campaign_id.in_(ids))
+                  .group_by(EmailLog.campaign_id)}
+        db.session.execute(
+            update(table)
+            .where(table.c.id == bindparam('cid'))
+            .values(open_count=bindparam('opens'), click_count=bindparam('clicks'),
+                    rollup_event_id=latest, rollup_at=now),
+            [{'cid': cid, 'opens': counts.get(cid, (0, 0))[0], 'clicks': counts.get(cid, (0, 0))[1]}
+             for cid in ids]
+        )
+        db.session.commit()
+    return len(campaign_ids)
+
+_rollup_lock = threading.Lock()
+_last_rollup = None
+
+def rollup_if_stale(interval, overlap=1000):
+    """
+    Runs rollup_engagement() unless this process ran it within `interval`
+    seconds or is running it right now. Errors are logged, not raised.
+    """
+    global _last_rollup
+    if _last_rollup is not None and time.monotonic() - _last_rollup < interval:
+        return 0
+    if not _rollup_lock.acquire(blocking=False):
+        return 0
+    try:
+        return rollup_engagement(overlap=overlap)
+    except Exception as e:
+        db.session.rollback()
+        metrics.error('rollup', f"Rollup error: {e}")
+        return 0
+    finally:
+        _last_rollup = time.monotonic()
+        _rollup_lock.release()
+
+EXPORT_HEADER = ('Email', 'Status', 'Error', 'Time', 'Opened At', 'Clicked At')
+
+def _fmt_time(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else ''
+
+def iter_export_csv(campaign_id, chunk_rows=1000, compress=False):
+    """
+    Yields the campaign's CSV export as bytes chunks of about `chunk_rows`
+    rows each, gzip-compressed if `compress` is set. Rows are fetched
+    `chunk_rows` at a time, so memory stays flat whatever the row count.
+    """
+    gzip = zlib.compressobj(wbits=31) if compress else None  # 31 = gzip container
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def take():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return gzip.compress(data) if gzip else data
+
+    writer.writerow(EXPORT_HEADER)
+    rows = db.session.execute(
+        select(EmailLog.email, EmailLog.status, EmailLog.error_message,
+               EmailLog.sent_at, EmailLog.opened_at, EmailLog.clicked_at)
+        .where(EmailLog.campaign_id == campaign_id)
+        .order_by(EmailLog.id)
+        .execution_options(yield_per=chunk_rows)  # server-side cursor on Postgres
+    )
+    for i, (email, status, error, sent_at, opened_at, clicked_at) in enumerate(rows, 1):
+        writer.writerow((email, status, error or '', _fmt_time(sent_at),
+                         _fmt_time(opened_at), _fmt_time(clicked_at)))
+        if i % chunk_rows == 0:
+            chunk = take()
+            if chunk:
+                yield chunk
+
+    chunk = take()
+    if gzip:
+        chunk += gzip.flush()
+    if chunk:
+        yield chunk
@@ -0,0 +1,263 @@
+"""
+Sender account pool.
+
+Every saved Settings row is a sender account with its own rate limit,
+daily quota and health. A campaign sent from the saved accounts spreads
+its recipients over all healthy ones: each send goes to the account with
+the fewest sends in flight (relative to its connections) that has a
+token in its own bucket, so faster accounts take a proportionally larger
+share. The From header is stamped at send time, after rendering.
+
+An account that answers with an authentication error is disabled until
+its settings are saved again; one that reports its sending quota used up
+is paused until the next UTC day. Either way the message is handed
+straight to the next healthy account. With more than one account the
+message arrives unserialized and From is set on it for the account that
+sends. Sends per account and per day are
+counted in the database, so every worker sees the same quota.
+"""
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import Message
+
+from sqlalchemy import case, update
+
+import metrics
+from metrics import COMMIT_SECONDS
+from models import db, Settings
+from engine import TokenBucket, resolve_send_limits, smtp_code
+from transports import open_transport
+from utils import SendError, send_message_smtp
+
+# Replies that mean the account itself can't send: bad login, or its
+# provider's sending limit is used up (e.g. Gmail's 550 5.4.5). A full
+# recipient mailbox ("over quota") is the recipient's problem, not ours.
+AUTH_CODES = {530, 534, 535}
+QUOTA_RE = re.compile(r'5\.4\.5|sending (quota|limit)', re.IGNORECASE)
+
+def account_failure(error):
+    """'auth', 'quota' or None for a send error."""
+    if not error:
+        return None
+    if smtp_code(error) in AUTH_CODES or 'authentication' in error.lower():
+        return 'auth'
+    if QUOTA_RE.search(error):
+        return 'quota'
+    return None
+
+def _next_day(now):
+    return datetime(now.year, now.month, now.day) + timedelta(days=1)
+
+class _Sender:
+    def __init__(self, account, transport, limits, quota_left):
+        self.account = account
+        self.transport = transport
+        self.bucket = TokenBucket(limits['rate'], limits['burst'])
+        self.rate = limits['rate']
+        self.burst = limits['burst']
+        self.max_connections = limits['max_connections']
+        self.quota_left = quota_left  # None: no daily quota
+        self.inflight = 0
+        self.sent = 0
+        self.failed = 0
+        self.state = 'active'
+        self.error = None
+
+    def available(self):
+        return self.state == 'active' and self.quota_left != 0
+
+class SenderPool:
+    """
+    Distributes sends over several sender accounts. transmit() is called
+    from the send engine's threads; sync() writes usage and health back
+    and must run on the caller's (database) thread.
+    """
+
+    def __init__(self, senders, sync_interval=1.0, clock=time.monotonic):
+        self.senders = senders
+        self.sync_interval = sync_interval
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._sent = {}  # account id -> sends not yet counted in the database
+        self._health = {}  # account id -> (status, paused_until, error)
+        self._last_sync = clock()
+
+    def available(self):
+        with self._cond:
+            return any(s.available() for s in self.senders)
+
+    @property
+    def from_address(self):
+        """The From address if there is just one account, else None (it depends on who sends)."""
+        return self.senders[0].account.email if len(self.senders) == 1 else None
+
+    def limits(self, campaign=None):
+        """The combined rate, burst and connections, capped by the campaign's own limits."""
+        with self._cond:
+            live = [s for s in self.senders if s.available()] or self.senders
+            limits = {
+                'rate': sum(s.rate for s in live),
+                'burst': sum(s.burst for s in live),
+                'max_connections': sum(s.max_connections for s in live),
+            }
+        for key, attr in (('rate', 'rate_per_second'), ('burst', 'burst'), ('max_connections', 'max_connections')):
+            value = getattr(campaign, attr, None)
+            if value:
+                limits[key] = min(limits[key], value)
+        limits['burst'] = max(1, int(limits['burst']))
+        limits['max_connections'] = max(1, int(limits['max_connections']))
+        return limits
+
+    def _acquire(self, skip):
+        """Blocks for the least loaded account with a free token; None if none is left."""
+        with self._cond:
+            while True:
+                candidates = [s for s in self.senders if s.available() and s not in skip]
+                if not candidates:
+                    return None
+                wait = None
+                for sender in sorted(candidates, key=lambda s: (s.inflight / s.max_connections, s.sent / s.rate)):
+                    if sender.inflight >= sender.max_connections:
+                        continue
+                    delay = sender.bucket.reserve()
+                    if not delay:
+                        sender.inflight += 1
+                        if sender.quota_left is not None:
+                            sender.quota_left -= 1
+                        return sender
+                    wait = delay if wait is None else min(wait, delay)
+                # Woken early when a send finishes or an account goes down
+                self._cond.wait(wait)
+
+    def _release(self, sender, ok, error):
+        with self._cond:
+            sender.inflight -= 1
+            if ok:
+                sender.sent += 1
+                if sender.account.id is not None:
+                    self._sent[sender.account.id] = self._sent.get(sender.account.id, 0) + 1
+            else:
+                sender.failed += 1
+                if sender.quota_left is not None:
+                    sender.quota_left += 1
+                self._mark(sender, account_failure(error), error)
+            self._cond.notify_all()
+
+    def _mark(self, sender, failure, error):
+        if failure is None or sender.state != 'active':
+            return
+        if failure == 'auth':
+            sender.state, paused_until = 'disabled', None
+        else:
+            sender.state, paused_until = 'paused', _next_day(datetime.utcnow())
+            sender.quota_left = 0
+        sender.error = str(error)
+        metrics.error('senders', f"Sender {sender.account.email} {sender.state}: {error}")
+        if sender.account.id is not None:
+            self._health[sender.account.id] = (sender.state, paused_until, sender.error)
+
+    def transmit(self, recipient, message):
+        """
+        Sends through the next healthy account, moving on if one fails as an
+        account. `message` is serialized, or a Message without From (see
+        from_address) that is stamped and serialized for each account tried.
+        """
+        tried = set()
+        while True:
+            sender = self._acquire(tried)
+            if sender is None:
+                error = SendError('No healthy sender account available')
+                error.transient = True
+                return False, error
+            email = sender.account.email
+            ok, error = (False, None)
+            try:
+                data = message
+                if isinstance(message, Message):
+                    del message['From']
+                    message['From'] = email
+                    data = message.as_string()
+                ok, error = send_message_smtp(email, sender.account.password, recipient, data,
+                                              pool=sender.transport)
+            finally:
+                self._release(sender, ok, error)
+            if ok or account_failure(error) is None:
+                return ok, error
+            tried.add(sender)
+
+    def sync(self, force=False):
+        """Writes send counts and health changes back, at most once per sync_interval."""
+        now = self._clock()
+        if not force and now - self._last_sync < self.sync_interval:
+            return
+        with self._cond:
+            sent, self._sent = self._sent, {}
+            health, self._health = self._health, {}
+        self._last_sync = now
+        if not sent and not health:
+            return
+        start = time.perf_counter()
+        today = datetime.utcnow().date()
+        for account_id, count in sent.items():
+            db.session.execute(
+                update(Settings)
+                .where(Settings.id == account_id)
+                .values(sent_today=case((Settings.quota_date == today, Settings.sent_today + count), else_=count),
+                        quota_date=today)
+            )
+        for account_id, (status, paused_until, error) in health.items():
+            db.session.execute(
+                update(Settings)
+                .where(Settings.id == account_id)
+                .values(status=status, paused_until=paused_until, last_error=error)
+            )
+        db.session.commit()
+        COMMIT_SECONDS.observe(time.perf_counter() - start, kind='senders')
+
+    def close(self):
+        for sender in self.senders:
+            sender.transport.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                s.account.email: {'sent': s.sent, 'failed': s.failed, 'state': s.state,
+                                  'quota_left': s.quota_left, 'transport': s.transport.stats()}
+                for s in self.senders
+            }
+
+def open_sender_pool(config, accounts, open_fn=open_transport):
+    """
+    A SenderPool over the accounts that may send right now: a password,
+    not disabled or paused, and quota left for today. Usage and health
+    are read fresh from the database; credentials come from the caller.
+    """
+    now = datetime.utcnow()
+    ids = [a.id for a in accounts if a.id is not None]
+    usage = {}
+    if ids:
+        usage = {row.id: row for row in db.session.query(
+            Settings.id, Settings.sent_today, Settings.quota_date, Settings.status, Settings.paused_until
+        ).filter(Settings.id.in_(ids))}
+
+    senders = []
+    for account in accounts:
+        if not account.password:
+            continue
+        row = usage.get(account.id)
+        if row is not None:
+            if row.status == 'disabled' or (row.paused_until and row.paused_until > now):
+                continue
+        quota = account.daily_quota or config.get('SENDER_DAILY_QUOTA', 0)
+        quota_left = None
+        if quota:
+            used = (row.sent_today or 0) if row is not None and row.quota_date == now.date() else 0
+            quota_left = max(0, quota - used)
+            if not quota_left:
+                continue
+        limits = resolve_send_limits(config, None, account)
+        transport = open_fn(account.email, account.password, config=config, size=limits['max_connections'])
+        senders.append(_Sender(account, transport, limits, quota_left))
+    return SenderPool(senders, sync_interval=config.get('RESULT_FLUSH_MS', 1000) / 1000)
@@ -0,0 +1,197 @@
+"""
+Campaign template compiler.
+
+A campaign's subject and HTML body are parsed once into a flat list of
+segments (literal text, merge tags, tracked links and the open pixel), so
+each recipient renders in a single join instead of one str.replace per
+merge key plus a regex pass for links.
+"""
+import re
+import threading
+from urllib.parse import quote
+
+MERGE_TAG_RE = re.compile(r'\{\{(.*?)\}\}')
+# Regex: href=" (http[s]?://...?) "
+# Handles double quotes. Todo: handle single quotes too if needed.
+LINK_RE = re.compile(r'href="(http[s]?://[^"]+)"')
+
+# Segment kinds
+LITERAL, MERGE, LINK, PIXEL = range(4)
+
+def _split_merge_tags(text):
+    """Splits text into LITERAL and MERGE segments."""
+    segments = []
+    pos = 0
+    for match in MERGE_TAG_RE.finditer(text):
+        if match.start() > pos:
+            segments.append((LITERAL, text[pos:match.start()]))
+        segments.append((MERGE, match.group(1)))
+        pos = match.end()
+    if pos < len(text):
+        segments.append((LITERAL, text[pos:]))
+    return segments
+
+def _split_links(text):
+    """Splits a chunk of HTML into literal/merge segments and LINK slots."""
+    segments = []
+    pos = 0
+    for match in LINK_RE.finditer(text):
+        segments.extend(_split_merge_tags(text[pos:match.start()]))
+        # A link slot keeps its URL as segments so merge tags inside it work
+        segments.append((LINK, tuple(_split_merge_tags(match.group(1)))))
+        pos = match.end()
+    segments.extend(_split_merge_tags(text[pos:]))
+    return segments
+
+def _merge_value(name, merge_data):
+    value = merge_data.get(name) if merge_data else None
+    # Empty values leave the tag in place, as the original renderer did
+    return str(value) if value else "{{" + name + "}}"
+
+def _render_plain(segments, values):
+    return ''.join(value if kind == LITERAL else values[value] for kind, value in segments)
+
+class _BoundTemplate:
+    """
+    A compiled body with everything that depends only on the base URL
+    (pixel markup, tracked link prefixes, quoted URL text) resolved ahead
+    of time. Rendering copies a list of literal parts and fills in the slots.
+    """
+
+    def __init__(self, segments, base_url):
+        parts = []
+        self.merge_slots = []
+        self.quoted_slots = []
+        self.log_id_slots = []
+
+        def literal(text):
+            # Coalesce adjacent literals so the final join stays short
+            if parts and isinstance(parts[-1], str):
+                parts[-1] += text
+            else:
+                parts.append(text)
+
+        def slot(target, value=None):
+            parts.append(None)
+            target.append((len(parts) - 1, value))
+
+        for kind, value in segments:
+            if kind == LITERAL:
+                literal(value)
+            elif kind == MERGE:
+                slot(self.merge_slots, value)
+            elif kind == PIXEL:
+                literal(f'<img src="{base_url}/track/open/')
+                slot(self.log_id_slots)
+                literal('" width="1" height="1" style="display:none;" />')
+            elif '/track/' in ''.join(v for k, v in value if k == LITERAL):
+                # Skip if already tracked
+                literal('href="')
+                for k, v in value:
+                    if k == LITERAL:
+                        literal(v)
+                    else:
+                        slot(self.merge_slots, v)
+                literal('"')
+            else:
+                literal(f'href="{base_url}/track/click/')
+                slot(self.log_id_slots)
+                literal('?url=')
+                # quote() works character by character, so the literal parts
+                # of the URL are quoted now and merge values at render time
+                for k, v in value:
+                    if k == LITERAL:
+                        literal(quote(v))
+                    else:
+                        slot(self.quoted_slots, v)
+                literal('"')
+        self.parts = parts
+        self.quoted_fields = frozenset(name for _, name in self.quoted_slots)
+
+    def render(self, values, log_id):
+        parts = self.parts[:]
+        for i, name in self.merge_slots:
+            parts[i] = values[name]
+        if self.quoted_slots:
+            quoted = {name: quote(values[name]) for name in self.quoted_fields}
+            for i, name in self.quoted_slots:
+                parts[i] = quoted[name]
+        log_id = str(log_id)
+        for i, _ in self.log_id_slots:
+            parts[i] = log_id
+        return ''.join(parts)
+
+class CompiledTemplate:
+    """
+    A campaign subject/body parsed into segments.
+    Only links written in the template itself are tracked; a link that a
+    merge value inserts is sent as-is, and whether a link is already tracked
+    is decided from the template text of its URL.
+    """
+
+    def __init__(self, subject, content_html):
+        self.subject_segments = _split_merge_tags(subject or '')
+
+        body = content_html or ''
+        segments = []
+        chunks = body.split('</body>')
+        if len(chunks) > 1:
+            # Pixel goes right before every closing body tag
+            for i, chunk in enumerate(chunks):
+                if i:
+                    segments.append((PIXEL, None))
+                    segments.append((LITERAL, '</body>'))
+                segments.extend(_split_links(chunk))
+        else:
+            segments.extend(_split_links(body))
+            segments.append((PIXEL, None))
+        self.body_segments = segments
+
+        # Merge fields the template actually uses
+        fields = set()
+        for kind, value in self.subject_segments + self.body_segments:
+            if kind == MERGE:
+                fields.add(value)
+            elif kind == LINK:
+                fields.update(v for k, v in value if k == MERGE)
+        self.fields = frozenset(fields)
+
+        self._bound = {}
+
+    def _bind(self, base_url):
+        bound = self._bound.get(base_url)
+        if bound is None:
+            bound = self._bound[base_url] = _BoundTemplate(self.body_segments, base_url)
+        return bound
+
+    def merge_values(self, merge_data):
+        """Resolves every referenced merge field once per recipient."""
+        return {name: _merge_value(name, merge_data) for name in self.fields}
+
+    def render(self, merge_data, log_id, base_url):
+        """Returns (subject, html) personalized for one recipient."""
+        values = self.merge_values(merge_data)
+        return (
+            _render_plain(self.subject_segments, values),
+            self._bind(base_url).render(values, log_id),
+        )
+
+_cache = {}
+_cache_lock = threading.Lock()
+CACHE_SIZE = 64
+
+def get_compiled_template(campaign):
+    """Returns the compiled template for a campaign, compiling it at most once per edit."""
+    with _cache_lock:
+        entry = _cache.get(campaign.id)
+        if entry and entry[0] == campaign.subject and entry[1] == campaign.content_html:
+            return entry[2]
+
+    compiled = CompiledTemplate(campaign.subject, campaign.content_html)
+    with _cache_lock:
+        _cache.pop(campaign.id, None)
+        _cache[campaign.id] = (campaign.subject, campaign.content_html, compiled)
+        while len(_cache) > CACHE_SIZE:
+            # Dicts keep insertion order, so this drops the oldest entry
+            del _cache[next(iter(_cache))]
+    return compiled
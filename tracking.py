@@ -0,0 +1,223 @@
+"""
+Write-behind ingestion for open/click tracking.
+
+Tracking routes append events to an in-process buffer and respond right
+away; a background thread drains the buffer every TRACKING_FLUSH_INTERVAL
+seconds (or sooner once TRACKING_BUFFER_MAX_EVENTS pile up) and coalesces
+them into a few bulk statements. With TRACKING_BUFFER disabled, e.g. on
+serverless hosts where threads don't outlive the request, each event is
+flushed before the response is sent.
+
+Every event is appended to TrackingEvent; EmailLog only keeps the first
+open and last click timestamps for quick filtering.
+"""
+import atexit
+import hashlib
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, insert, null, or_, update
+
+import metrics
+from metrics import COMMIT_SECONDS, TRACKING_BUFFER_DEPTH
+from models import db, EmailLog, TrackingEvent
+
+def url_hash(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+class TrackingBuffer:
+    """Collects tracking events and writes them to the database in batches."""
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._opens = []
+        self._clicks = []
+        self._pending = 0
+        self._thread = None
+        self._pid = None
+        self.events_flushed = 0
+        self.flushes = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('TRACKING_BUFFER', True)
+        self.interval = app.config.get('TRACKING_FLUSH_INTERVAL', 1.0)
+        self.max_events = app.config.get('TRACKING_BUFFER_MAX_EVENTS', 5000)
+        atexit.register(self.flush)
+
+    def _ensure_thread(self):
+        # Started lazily (and again after a fork) so importing the app stays cheap
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='tracking-flush', daemon=True)
+            self._thread.start()
+
+    def _added(self):
+        self._pending += 1
+        if self._pending >= self.max_events:
+            self._wake.set()
+
+    def record_open(self, log_id, ts=None):
+        ts = ts or datetime.utcnow()
+        with self._lock:
+            self._opens.append((log_id, ts))
+            self._added()
+        self._after_record()
+
+    def record_click(self, log_id, url, ts=None):
+        ts = ts or datetime.utcnow()
+        with self._lock:
+            self._clicks.append((log_id, url, ts))
+            self._added()
+        self._after_record()
+
+    def _after_record(self):
+        if self.enabled:
+            self._ensure_thread()
+        else:
+            self.flush()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                metrics.error('tracking', f"Tracking flush error: {e}")
+
+    def _take(self):
+        with self._lock:
+            opens, clicks = self._opens, self._clicks
+            self._opens, self._clicks = [], []
+            count, self._pending = self._pending, 0
+        return opens, clicks, count
+
+    def flush(self):
+        """Writes all buffered events. Safe to call from any thread."""
+        opens, clicks, count = self._take()
+        if not count:
+            return
+        with self.app.app_context():
+            try:
+                with COMMIT_SECONDS.time(kind='tracking'):
+                    self._write(opens, clicks)
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+        self.flushes += 1
+        self.events_flushed += count
+
+    def _write(self, opens, clicks):
+        log_ids = {log_id for log_id, _ in opens} | {log_id for log_id, _, _ in clicks}
+        # One PK lookup per flush; events for unknown logs are dropped
+        campaigns = dict(db.session.query(EmailLog.id, EmailLog.campaign_id)
+                         .filter(EmailLog.id.in_(log_ids)))
+
+        events = [
+            {'log_id': log_id, 'campaign_id': campaigns[log_id], 'kind': 'open',
+             'url_hash': None, 'url': None, 'ts': ts}
+            for log_id, ts in opens if log_id in campaigns
+        ]
+        events.extend(
+            {'log_id': log_id, 'campaign_id': campaigns[log_id], 'kind': 'click',
+             'url_hash': url_hash(url), 'url': url, 'ts': ts}
+            for log_id, url, ts in clicks if log_id in campaigns
+        )
+        if events:
+            db.session.execute(insert(TrackingEvent), events)
+
+        table = EmailLog.__table__
+        # First open per log, last click per log
+        first_open = {}
+        for log_id, ts in opens:
+            if log_id in campaigns and (log_id not in first_open or ts < first_open[log_id]):
+                first_open[log_id] = ts
+        last_click = {}
+        for log_id, _, ts in clicks:
+            if log_id in campaigns and (log_id not in last_click or ts > last_click[log_id]):
+                last_click[log_id] = ts
+
+        if first_open:
+            db.session.execute(
+                update(table)
+                .where(table.c.id == bindparam('log_id'), table.c.opened_at.is_(None))
+                .values(opened_at=bindparam('ts')),
+                [{'log_id': log_id, 'ts': ts} for log_id, ts in first_open.items()]
+            )
+        if last_click:
+            db.session.execute(
+                update(table)
+                .where(table.c.id == bindparam('log_id'),
+                       or_(table.c.clicked_at.is_(None), table.c.clicked_at < bindparam('ts')))
+                .values(clicked_at=bindparam('ts')),
+                [{'log_id': log_id, 'ts': ts} for log_id, ts in last_click.items()]
+            )
+
+        db.session.commit()
+
+    def stats(self):
+        with self._lock:
+            pending = self._pending
+        return {'pending': pending, 'flushes': self.flushes, 'events_flushed': self.events_flushed}
+
+tracking_buffer = TrackingBuffer()
+TRACKING_BUFFER_DEPTH.function = lambda: tracking_buffer.stats()['pending']
+
+def link_click_counts(campaign_id, limit=None):
+    """Per-link clicks for a campaign, aggregated in SQL, busiest first."""
+    clicks = func.count(TrackingEvent.id).label('clicks')
+    query = (db.session.query(
+                 func.min(TrackingEvent.url).label('url'),
+                 clicks,
+                 func.count(func.distinct(TrackingEvent.log_id)).label('recipients'))
+             .filter(TrackingEvent.campaign_id == campaign_id, TrackingEvent.kind == 'click')
+             .group_by(TrackingEvent.url_hash)
+             .order_by(clicks.desc()))
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+def backfill_tracking_events(batch_size=1000):
+    """
+    Moves click history from the legacy EmailLog.links_clicked JSON into
+    TrackingEvent rows, clearing the JSON as it goes so it can be re-run.
+    Returns the number of events created.
+    """
+    created = 0
+    while True:
+        logs = (db.session.query(EmailLog.id, EmailLog.campaign_id, EmailLog.links_clicked)
+                .filter(EmailLog.links_clicked.isnot(None))
+                .order_by(EmailLog.id)
+                .limit(batch_size)
+                .all())
+        if not logs:
+            return created
+
+        events = []
+        for log_id, campaign_id, links in logs:
+            for click in links if isinstance(links, list) else []:
+                url = click.get('url') if isinstance(click, dict) else None
+                if not url:
+                    continue
+                try:
+                    ts = datetime.fromisoformat(click.get('time'))
+                except (TypeError, ValueError):
+                    ts = datetime.utcnow()
+                events.append({'log_id': log_id, 'campaign_id': campaign_id, 'kind': 'click',
+                               'url_hash': url_hash(url), 'url': url, 'ts': ts})
+        if events:
+            db.session.execute(insert(TrackingEvent), events)
+        # null() writes SQL NULL; a plain None would store the JSON 'null'
+        db.session.execute(
+            update(EmailLog.__table__)
+            .where(EmailLog.__table__.c.id.in_([log_id for log_id, _, _ in logs]))
+            .values(links_clicked=null())
+        )
+        db.session.commit()
+        created += len(events)
@@ -0,0 +1,28 @@
+"""
+Minimal app serving only the open/click tracking routes.
+
+    gunicorn tracking_app:app
+
+A tracking hit is the busiest request by far. Served from here it only
+imports Flask, the models and the tracking buffer, so serverless cold
+starts skip everything the dashboard, sending and imports need (see
+benchmarks/bench_importtime.py). vercel.json routes /track/ here.
+"""
+from flask import Flask
+
+from config import Config
+from migrations import init_app as init_schema
+from models import db
+from tracking import tracking_buffer
+from tracking_routes import tracking_bp
+
+def create_tracking_app(config=Config):
+    app = Flask(__name__)
+    app.config.from_object(config)
+    db.init_app(app)
+    tracking_buffer.init_app(app)
+    init_schema(app)
+    app.register_blueprint(tracking_bp)
+    return app
+
+app = create_tracking_app()
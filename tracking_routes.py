@@ -0,0 +1,47 @@
+"""
+Open/click tracking routes.
+
+Registered by the full app and by the minimal tracking_app, so keep the
+imports here light: no sending, importing, reports or encryption.
+"""
+from io import BytesIO
+
+from flask import Blueprint, redirect, request, send_file
+
+import metrics
+from metrics import TRACKING_EVENTS_TOTAL
+from tracking import tracking_buffer
+
+# 1x1 transparent PNG
+PIXEL = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4'
+         b'\x89\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa7\xd4\xd6\xe7\x00\x00\x00\x00IEND'
+         b'\xaeB`\x82')
+
+tracking_bp = Blueprint('tracking', __name__)
+
+@tracking_bp.route('/track/open/<int:log_id>')
+def track_open(log_id):
+    """Records an email open event."""
+    try:
+        # Buffered; written in bulk by the tracking flusher
+        tracking_buffer.record_open(log_id)
+        TRACKING_EVENTS_TOTAL.inc(kind='open')
+    except Exception as e:
+        metrics.error('tracking', f"Tracking error: {e}")
+    return send_file(BytesIO(PIXEL), mimetype='image/png')
+
+@tracking_bp.route('/track/click/<int:log_id>')
+def track_click(log_id):
+    """Records a link click and redirects."""
+    target_url = request.args.get('url')
+    if not target_url:
+        return "Invalid Link", 400
+
+    try:
+        # Buffered; written in bulk by the tracking flusher
+        tracking_buffer.record_click(log_id, target_url)
+        TRACKING_EVENTS_TOTAL.inc(kind='click')
+    except Exception as e:
+        metrics.error('tracking', f"Click tracking error: {e}")
+
+    return redirect(target_url)
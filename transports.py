@@ -0,0 +1,318 @@
+"""
+Mail transports.
+
+Everything that takes a serialized message and delivers it: pooled SMTP
+(implicit TLS, STARTTLS or plain), LMTP to a local delivery agent, a
+maildir sink and an in-memory null sink. They share one interface,
+sendmail(from_addr, to_addrs, msg) / stats() / close(), and are safe to
+share between send threads.
+
+MAIL_TRANSPORT picks one by URL; unset, the SMTP_* settings are used.
+
+    smtps://smtp.gmail.com:465        implicit TLS
+    smtp+starttls://relay:587         STARTTLS
+    smtp://localhost:1025             plain, e.g. a local relay or aiosmtpd
+    lmtp://localhost:24               LMTP over TCP
+    lmtp:///var/run/dovecot/lmtp      LMTP over a unix socket
+    maildir:///tmp/outbox             write each message into a maildir
+    null://?latency_ms=20             count and drop, after a fake delay
+
+The sinks never touch the network, so a whole campaign (rendering, the
+database, scheduling) can be load-tested on a laptop.
+"""
+import mailbox
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from flask import current_app
+
+from metrics import SMTP_CONNECT_SECONDS
+
+class PooledSMTPConnection:
+    """A single authenticated SMTP session plus its usage counters."""
+
+    def __init__(self, conn_id, server):
+        self.id = conn_id
+        self.server = server
+        self.messages = 0
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+class SMTPConnectionPool:
+    """
+    Keeps up to `size` authenticated SMTP sessions alive across recipients.
+    Sessions are opened lazily, retired after `max_messages` sends, and
+    re-established once if the server drops them between messages.
+    Safe to share between threads.
+    use_ssl: implicit TLS from the first byte (port 465)
+    starttls: upgrade a plain connection after EHLO (port 587)
+    lmtp: speak LMTP instead (a host starting with '/' is a unix socket)
+    """
+
+    def __init__(self, sender_email, sender_password, host='smtp.gmail.com', port=465,
+                 use_ssl=True, starttls=False, lmtp=False, size=1, max_messages=100, timeout=30):
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.starttls = starttls
+        self.lmtp = lmtp
+        self.size = max(1, size)
+        self.max_messages = max_messages
+        self.timeout = timeout
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._retired = []
+        self._active = {}
+        self.reconnects = 0
+
+    @classmethod
+    def from_config(cls, sender_email, sender_password, config=None, size=None):
+        """Builds a pool from the SMTP_* settings of the current app."""
+        config = config or current_app.config
+        return cls(
+            sender_email,
+            sender_password,
+            host=config.get('SMTP_SERVER', 'smtp.gmail.com'),
+            port=config.get('SMTP_PORT', 465),
+            use_ssl=config.get('SMTP_USE_SSL', True),
+            starttls=config.get('SMTP_STARTTLS', False),
+            size=size or config.get('SMTP_POOL_SIZE', 1),
+            max_messages=config.get('SMTP_MAX_MESSAGES_PER_CONNECTION', 100),
+        )
+
+    def _connect(self):
+        with SMTP_CONNECT_SECONDS.time():
+            server = self._open()
+        with self._lock:
+            conn = PooledSMTPConnection(self._next_id, server)
+            self._next_id += 1
+            self._active[conn.id] = conn
+        return conn
+
+    def _open(self):
+        if self.lmtp:
+            server = smtplib.LMTP(self.host, self.port, timeout=self.timeout)
+        elif self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            if self.starttls:
+                server.starttls(context=ssl.create_default_context())
+                server.ehlo()
+            # Local stand-ins (aiosmtpd, smtpd) usually don't offer AUTH
+            if self.sender_password and server.has_extn('auth'):
+                server.login(self.sender_email, self.sender_password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _retire(self, conn):
+        conn.close()
+        with self._lock:
+            if self._active.pop(conn.id, None) is not None:
+                self._retired.append(conn)
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn):
+        if conn is not None:
+            if self.max_messages and conn.messages >= self.max_messages:
+                self._retire(conn)
+            else:
+                self._idle.put(conn)
+        self._slots.release()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Sends a serialized message over a pooled session."""
+        conn = self._acquire()
+        try:
+            try:
+                conn.server.sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                # Idle sessions get dropped by the server; reconnect once.
+                self._retire(conn)
+                conn = None
+                conn = self._connect()
+                with self._lock:
+                    self.reconnects += 1
+                conn.server.sendmail(from_addr, to_addrs, msg)
+            conn.messages += 1
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # The server answered, so the session itself is still usable
+            self._release(conn)
+            raise
+        except Exception:
+            if conn is not None:
+                self._retire(conn)
+            self._release(None)
+            raise
+        self._release(conn)
+
+    def stats(self):
+        """Per-connection reuse counts, including retired connections."""
+        with self._lock:
+            conns = self._retired + list(self._active.values())
+            return {
+                'connections_opened': self._next_id - 1,
+                'reconnects': self.reconnects,
+                'messages': sum(c.messages for c in conns),
+                'per_connection': {c.id: c.messages for c in conns},
+            }
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._retire(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NullTransport:
+    """
+    Accepts every message and drops it, optionally after `latency` seconds
+    to stand in for a network round trip. Only counts what it was given.
+    """
+
+    def __init__(self, latency=0.0, sleep=time.sleep):
+        self.latency = latency
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.latency:
+            self._sleep(self.latency)
+        with self._lock:
+            self.messages += 1
+            self.recipients += 1 if isinstance(to_addrs, str) else len(to_addrs)
+            self.bytes += len(msg)
+
+    def stats(self):
+        with self._lock:
+            return {'messages': self.messages, 'recipients': self.recipients, 'bytes': self.bytes}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class MaildirTransport(NullTransport):
+    """
+    Delivers every message into a maildir (created if missing), where any
+    mail client or a quick `ls new/` can inspect it. Envelope addresses are
+    kept in X-Envelope-From / X-Envelope-To headers.
+    """
+
+    def __init__(self, path, latency=0.0, sleep=time.sleep):
+        super().__init__(latency, sleep)
+        self.path = path
+        # Maildir only creates its subdirectories along with a missing path,
+        # so an existing empty directory (e.g. a mounted volume) needs them too
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+        # Maildir writes to tmp/ and renames into new/, so threads can share it
+        self._maildir = mailbox.Maildir(path, create=False)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        to = to_addrs if isinstance(to_addrs, str) else ', '.join(to_addrs)
+        # "\n" like msg.as_string(), so the stored file has one line ending
+        envelope = f"X-Envelope-From: {from_addr}\nX-Envelope-To: {to}\n"
+        self._maildir.add(envelope + msg)
+        super().sendmail(from_addr, to_addrs, msg)
+
+    def stats(self):
+        stats = super().stats()
+        stats['path'] = self.path
+        return stats
+
+SMTP_SCHEMES = {
+    # scheme: (use_ssl, starttls, lmtp, default port)
+    'smtp': (False, False, False, 25),
+    'smtps': (True, False, False, 465),
+    'smtp+starttls': (False, True, False, 587),
+    'lmtp': (False, False, True, smtplib.LMTP_PORT),
+}
+
+def open_transport(sender_email, sender_password, config=None, size=None):
+    """
+    Builds the transport configured by MAIL_TRANSPORT (see the module
+    docstring), or an SMTPConnectionPool from the SMTP_* settings.
+    size caps the number of pooled connections.
+    """
+    config = config or current_app.config
+    url = config.get('MAIL_TRANSPORT')
+    if not url:
+        return SMTPConnectionPool.from_config(sender_email, sender_password, config=config, size=size)
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+    latency = float(params.get('latency_ms', 0)) / 1000
+
+    if scheme == 'null':
+        return NullTransport(latency)
+    if scheme == 'maildir':
+        path = unquote(parts.netloc + parts.path)
+        if not path:
+            raise ValueError("maildir transport needs a path, e.g. maildir:///tmp/outbox")
+        return MaildirTransport(os.path.expanduser(path), latency)
+    if scheme not in SMTP_SCHEMES:
+        raise ValueError(f"Unknown MAIL_TRANSPORT scheme: {parts.scheme!r}")
+
+    use_ssl, starttls, lmtp, default_port = SMTP_SCHEMES[scheme]
+    # lmtp:///path/to/socket has no host; smtplib.LMTP treats '/...' as a socket
+    host = parts.hostname or unquote(parts.path)
+    return SMTPConnectionPool(
+        sender_email,
+        sender_password,
+        host=host,
+        port=parts.port or default_port,
+        use_ssl=use_ssl,
+        starttls=starttls,
+        lmtp=lmtp,
+        size=size or config.get('SMTP_POOL_SIZE', 1),
+        max_messages=config.get('SMTP_MAX_MESSAGES_PER_CONNECTION', 100),
+    )
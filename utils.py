@@ -1,18 +1,33 @@
+import base64
 import smtplib
 import os
+import threading
+import time
+from collections import OrderedDict
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
-from cryptography.fernet import Fernet
+from email.message import Message
 from flask import current_app
 
+import metrics
+from blobs import read_mapped
+from metrics import SEND_SECONDS
+from transports import open_transport
+
+_fernets = {}
+
 def get_fernet():
-    """Returns a Fernet instance using the app's encryption key."""
+    """Returns the Fernet instance for the app's encryption key (built once per key)."""
     key = current_app.config['ENCRYPTION_KEY']
     if not key:
         raise ValueError("ENCRYPTION_KEY not set in configuration")
-    return Fernet(key.encode() if isinstance(key, str) else key)
+    cipher = _fernets.get(key)
+    if cipher is None:
+        # Imported here: cryptography is slow to load and only a few routes need it
+        from cryptography.fernet import Fernet
+        cipher = _fernets[key] = Fernet(key.encode() if isinstance(key, str) else key)
+    return cipher
 
 def encrypt_password(password: str) -> str:
     """Encrypts a password."""
@@ -24,48 +39,210 @@ def decrypt_password(encrypted_password: str) -> str:
     cipher = get_fernet()
     return cipher.decrypt(encrypted_password.encode()).decode()
 
-def send_email_smtp(sender_email, sender_password, recipient_email, subject, html_content, attachments=None):
+# Raw bytes encoded at a time: a multiple of the 57 bytes per base64 line,
+# so the chunks join up into the same lines as encoding it all at once
+ENCODE_CHUNK = 57 * 16 * 1024
+
+def encode_attachment(filepath, filename=None):
     """
-    Sends an email using Gmail SMTP with optional attachment support.
-    attachments: List of file paths (strings)
-    Returns (True, None) on success, or (False, error_message) on failure.
+    Encodes a file as a base64 MIME attachment part. The file is
+    memory-mapped and encoded a chunk at a time, so only one chunk of raw
+    bytes is copied at once; the encoded payload itself is held in full,
+    as the part needs it.
+    """
+    data = read_mapped(filepath)
+    try:
+        payload = ''.join(base64.encodebytes(data[start:start + ENCODE_CHUNK]).decode('ascii')
+                          for start in range(0, len(data), ENCODE_CHUNK))
+    finally:
+        if data:
+            data.close()
+    part = MIMEBase("application", "octet-stream")
+    # Same line layout as email.encoders.encode_base64
+    part.set_payload(payload)
+    part['Content-Transfer-Encoding'] = 'base64'
+    filename = filename or os.path.basename(filepath)
+    part.add_header(
+        "Content-Disposition",
+        f"attachment; filename= {filename}",
+    )
+    return part
+
+class AttachmentCache:
+    """
+    Process-wide LRU cache of encoded attachment parts, keyed by content
+    (the blob's sha256, or the CampaignAttachment id for legacy uploads),
+    file name and mtime, so campaigns sharing a file share its part and a
+    replaced file is re-read.
+    A part is encoded once and attached by reference to every recipient's
+    message. Memory is bounded by `max_bytes` of encoded payload; a file
+    larger than the whole budget is encoded per message instead.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._parts = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, attachment_id, filepath, filename=None):
+        """Returns the encoded part for an attachment, or None if the file is missing."""
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            metrics.error('attachments', f"Attachment not found: {filepath}")
+            return None
+
+        key = (attachment_id, filename, mtime)
+        with self._lock:
+            part = self._parts.get(key)
+            if part is not None:
+                self._parts.move_to_end(key)
+                self.hits += 1
+                return part
+            self.misses += 1
+
+        part = encode_attachment(filepath, filename)
+        size = len(part.get_payload())
+        if size > self.max_bytes:
+            return part
+
+        with self._lock:
+            if key not in self._parts:
+                self._parts[key] = part
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, old = self._parts.popitem(last=False)
+                self.bytes -= len(old.get_payload())
+                self.evictions += 1
+        return part
+
+    def parts_for(self, attachments):
+        """Encoded parts for a campaign's CampaignAttachment rows."""
+        parts = []
+        for att in attachments:
+            try:
+                part = self.get(att.sha256 or att.id, att.filepath, att.filename)
+            except Exception as e:
+                metrics.error('attachments', f"Error attaching file {att.filepath}: {e}")
+                continue
+            if part is not None:
+                parts.append(part)
+        return parts
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._parts),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+_attachment_cache = None
+
+def get_attachment_cache(config=None):
+    """Returns the process-wide attachment cache, sized from ATTACHMENT_CACHE_MAX_BYTES."""
+    global _attachment_cache
+    if _attachment_cache is None:
+        config = config or current_app.config
+        _attachment_cache = AttachmentCache(config.get('ATTACHMENT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    return _attachment_cache
+
+def build_message(sender_email, recipient_email, subject, html_content, attachments=None):
+    """
+    Builds the MIME message for one recipient. Without a sender_email the
+    From header is left for the caller to add (see senders.SenderPool).
+    attachments: file paths, or parts already encoded by AttachmentCache
     """
     msg = MIMEMultipart()
-    msg['From'] = sender_email
+    if sender_email:
+        msg['From'] = sender_email
     msg['To'] = recipient_email
     msg['Subject'] = subject
-    
+
     msg.attach(MIMEText(html_content, 'html'))
-    
+
     if attachments:
-        for filepath in attachments:
+        for attachment in attachments:
+            if isinstance(attachment, Message):
+                # Shared part; serializing the message doesn't modify it
+                msg.attach(attachment)
+                continue
             try:
-                if os.path.exists(filepath):
-                   with open(filepath, "rb") as attachment:
-                        part = MIMEBase("application", "octet-stream")
-                        part.set_payload(attachment.read())
-                    
-                   encoders.encode_base64(part)
-                   filename = os.path.basename(filepath)
-                   part.add_header(
-                        "Content-Disposition",
-                        f"attachment; filename= {filename}",
-                   )
-                   msg.attach(part)
+                if os.path.exists(attachment):
+                    msg.attach(encode_attachment(attachment))
                 else:
-                    print(f"Attachment not found: {filepath}")
+                    metrics.error('attachments', f"Attachment not found: {attachment}")
             except Exception as e:
-                print(f"Error attaching file {filepath}: {e}")
+                metrics.error('attachments', f"Error attaching file {attachment}: {e}")
+
+    return msg
+
+def send_email_smtp(sender_email, sender_password, recipient_email, subject, html_content, attachments=None, pool=None):
+    """
+    Sends an email over SMTP with optional attachment support.
+    attachments: List of file paths (strings) or pre-encoded MIME parts
+    pool: Optional transport (see transports.py) to reuse, e.g. a pooled session
+    Returns (True, None) on success, or (False, error_message) on failure.
+    """
+    msg = build_message(sender_email, recipient_email, subject, html_content, attachments)
+    return send_message_smtp(sender_email, sender_password, recipient_email, msg.as_string(), pool=pool)
 
+class SendError(str):
+    """
+    A failure message that also records whether retrying later may work.
+    It is still a plain string everywhere else (logs, error_message).
+    """
+    transient = False
+
+def send_error(exc):
+    """
+    Classifies a send exception. 4xx replies and network trouble (resets,
+    timeouts, dropped sessions) are transient; 5xx replies and anything
+    else are permanent.
+    """
+    error = SendError(str(exc) or type(exc).__name__)
+    if isinstance(exc, smtplib.SMTPResponseException):
+        error.transient = 400 <= exc.smtp_code < 500
+    elif isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        error.transient = bool(codes) and all(400 <= code < 500 for code in codes)
+    elif isinstance(exc, smtplib.SMTPServerDisconnected):
+        error.transient = True
+    elif isinstance(exc, smtplib.SMTPException):
+        # Protocol problems (e.g. unsupported extension) won't fix themselves
+        error.transient = False
+    elif isinstance(exc, OSError):
+        # Connection refused/reset, timeouts, DNS hiccups
+        error.transient = True
+    return error
+
+def is_transient(error):
+    return getattr(error, 'transient', False)
+
+def send_message_smtp(sender_email, sender_password, recipient_email, message, pool=None):
+    """
+    Sends an already serialized message over `pool`, or a one-off
+    transport from MAIL_TRANSPORT / SMTP_* settings.
+    Returns (True, None) on success, or (False, error) on failure, where
+    error is a SendError telling whether the failure is transient.
+    """
+    start = time.perf_counter()
     try:
-        # Gmail SMTP configuration
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 465
-        
-        with smtplib.SMTP_SSL(smtp_server, smtp_port) as server:
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, recipient_email, msg.as_string())
-        
-        return True, None
+        if pool is not None:
+            pool.sendmail(sender_email, recipient_email, message)
+        else:
+            one_off = open_transport(sender_email, sender_password)
+            with one_off:
+                one_off.sendmail(sender_email, recipient_email, message)
     except Exception as e:
-        return False, str(e)
+        SEND_SECONDS.observe(time.perf_counter() - start, result='error')
+        return False, send_error(e)
+    SEND_SECONDS.observe(time.perf_counter() - start, result='ok')
+    return True, None
@@ -0,0 +1,548 @@
+"""
+Standalone send worker.
+
+    python -m worker
+
+Campaigns are queued as SendJob rows. A worker picks up any active job,
+leases a batch of its pending EmailLog rows, sends them, and renews the
+lease while it works. If a worker dies (deploy, recycle, timeout) its
+leases simply expire and the next worker resumes the campaign, so any
+number of worker processes can share the same queue.
+"""
+import contextlib
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Campaign, CampaignColumns, EmailLog, SendJob
+from utils import encrypt_password, is_transient, get_attachment_cache
+from engine import DomainScheduler, TokenBucket, parse_domain_limit, parse_domain_map
+from pipeline import SendPipeline
+from templating import get_compiled_template
+from progress import progress_cache
+from credentials import SenderAccount, credential_cache
+from senders import open_sender_pool
+from reports import rollup_if_stale
+from migrations import upgrade as upgrade_schema
+import metrics
+from metrics import COMMIT_SECONDS, EMAILS_TOTAL, SEND_QUEUE_DEPTH
+
+def make_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+def enqueue_campaign(campaign_id, base_url, sender_email=None, sender_password=None):
+    """
+    Queues a campaign for sending.
+    Returns the new SendJob, or None if the campaign is already queued.
+    """
+    job = SendJob(
+        campaign_id=campaign_id,
+        base_url=base_url,
+        sender_email=sender_email or None,
+        encrypted_password=encrypt_password(sender_password) if sender_password else None
+    )
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Unique campaign_id: another request queued it first
+        db.session.rollback()
+        return None
+    return job
+
+def resume_stale_job(campaign_id, lease_seconds, sender_email=None, sender_password=None):
+    """
+    The campaign's unfinished SendJob if whoever was working on it is gone:
+    no heartbeat within `lease_seconds` and no live leases (e.g. an inline
+    send thread killed by a worker recycle or deploy). New credentials, if
+    given, replace the stored ones. Returns None if the job is finished or
+    still being worked on.
+    """
+    job = SendJob.query.filter_by(campaign_id=campaign_id).first()
+    if not job or job.status == 'completed':
+        return None
+    now = datetime.utcnow()
+    last_seen = max(t for t in (job.heartbeat_at, job.started_at, job.created_at) if t)
+    if now - last_seen < timedelta(seconds=lease_seconds):
+        return None
+    leased = (db.session.query(EmailLog.id)
+              .filter(EmailLog.campaign_id == campaign_id, EmailLog.lease_expires_at > now)
+              .first())
+    if leased:
+        return None
+    if sender_email and sender_password:
+        job.sender_email = sender_email
+        job.encrypted_password = encrypt_password(sender_password)
+    job.heartbeat_at = now
+    db.session.commit()
+    return job
+
+# Statuses a log can still be sent from
+OPEN_STATUSES = ('pending', 'retry')
+
+def _claimable(campaign_id, now):
+    return and_(
+        EmailLog.campaign_id == campaign_id,
+        or_(EmailLog.status == 'pending',
+            and_(EmailLog.status == 'retry', EmailLog.next_attempt_at <= now)),
+        or_(EmailLog.lease_expires_at.is_(None), EmailLog.lease_expires_at < now)
+    )
+
+def merge_field_loader(campaign_id, fields):
+    """
+    Returns (columns, build): SQL expressions that load only the merge
+    fields a template uses, and build(row) turning a claim_batch row back
+    into the {name: value} dict the renderer takes. Campaigns imported
+    before CampaignColumns existed keep a merge_data dict per row.
+    """
+    fields = sorted(fields)
+    layout = db.session.get(CampaignColumns, campaign_id)
+    columns, sources = [], []
+    for name in fields:
+        if name == 'email' or (layout and name == layout.email_column):
+            sources.append(None)
+        elif layout is None:
+            sources.append(len(columns))
+            columns.append(EmailLog.merge_data[name])
+        elif name in layout.names:
+            sources.append(len(columns))
+            columns.append(EmailLog.merge_values[layout.names.index(name)])
+        else:
+            # Not a column of this list; the tag stays as written
+            sources.append(-1)
+
+    def build(row):
+        values = row[3:]
+        data = {}
+        for name, source in zip(fields, sources):
+            if source is None:
+                data[name] = row.email
+            elif source >= 0:
+                data[name] = values[source]
+        return data
+    return columns, build
+
+def claim_batch(campaign_id, worker_id, size, lease_seconds, columns=()):
+    """
+    Leases up to `size` pending logs (or retries that are due) of a campaign
+    to this worker. Returns (id, email, retry_count, *columns) rows.
+    Postgres skips rows other workers have locked; on SQLite the conditional
+    UPDATE acts as a compare-and-swap, so rows claimed in between are dropped.
+    """
+    now = datetime.utcnow()
+    query = (db.session.query(EmailLog.id)
+             .filter(_claimable(campaign_id, now))
+             .order_by(EmailLog.id)
+             .limit(size))
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+
+    ids = [row.id for row in query]
+    if not ids:
+        db.session.commit()
+        return []
+
+    db.session.execute(
+        update(EmailLog)
+        .where(EmailLog.id.in_(ids), _claimable(campaign_id, now))
+        .values(lease_owner=worker_id, lease_expires_at=now + timedelta(seconds=lease_seconds))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    return (db.session.query(EmailLog.id, EmailLog.email, EmailLog.retry_count, *columns)
+            .filter(EmailLog.id.in_(ids), EmailLog.lease_owner == worker_id)
+            .order_by(EmailLog.id)
+            .all())
+
+def heartbeat(job, worker_id, lease_seconds):
+    """Extends this worker's leases on unsent logs of the job's campaign."""
+    now = datetime.utcnow()
+    db.session.execute(
+        update(EmailLog)
+        .where(EmailLog.campaign_id == job.campaign_id,
+               EmailLog.status.in_(OPEN_STATUSES),
+               EmailLog.lease_owner == worker_id)
+        .values(lease_expires_at=now + timedelta(seconds=lease_seconds))
+        .execution_options(synchronize_session=False)
+    )
+    job.heartbeat_at = now
+    db.session.commit()
+
+def _sender_accounts(job):
+    """
+    Credentials stored on the job win (one account, with the saved limits
+    and quota of that address if any); otherwise every saved account.
+    """
+    if not job.encrypted_password:
+        return credential_cache.accounts()
+    password = credential_cache.decrypt(job.encrypted_password)
+    default = credential_cache.default()
+    email = job.sender_email or (default.email if default else None)
+    if not email:
+        return []
+    saved = credential_cache.get(email)
+    if saved:
+        return [saved._replace(password=password)]
+    return [SenderAccount(None, email, password, None, None, None, None)]
+
+def retry_delay(retry_count, base, maximum, rand=random.random):
+    """Exponential backoff with jitter: between half and all of base * 2^n."""
+    delay = min(maximum, base * 2 ** retry_count)
+    return delay / 2 + rand() * delay / 2
+
+class ResultFlusher:
+    """
+    Buffers send results and writes them in batches.
+
+    A flush happens once `max_rows` results are waiting or the oldest one
+    is `max_ms` old. Each flush is a single transaction: one
+    UPDATE ... WHERE id IN (...) for sent rows, one per distinct error for
+    failed rows, one executemany for rows to retry, and one atomic counter
+    increment on the campaign.
+
+    Transient failures (see utils.send_error) move to status 'retry' with
+    next_attempt_at set by retry_delay(), until `max_retries` is used up;
+    then, like permanent failures, they are marked failed. Logs postponed
+    because their domain is backing off go to 'retry' as well, with
+    next_attempt_at at the end of the pause and the same retry_count.
+
+    Crash safety: results still in the buffer are lost if the worker dies,
+    but those logs are still 'pending' and leased, so they are sent again
+    once the lease expires (at-least-once delivery; at most max_rows plus
+    the in-flight sends can go out twice). Updates only touch rows that
+    are still pending or retrying, and the counters are incremented by the matched row
+    counts, so statuses and counters always agree even after a re-send.
+    """
+
+    def __init__(self, campaign_id, max_rows=100, max_ms=1000, max_retries=5,
+                 retry_base=60, retry_max=3600, clock=time.monotonic):
+        self.campaign_id = campaign_id
+        self.max_rows = max(1, max_rows)
+        self.max_seconds = max_ms / 1000
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._clock = clock
+        self._retry_counts = {}
+        self._sent = []
+        self._failed = {}
+        self._retry = []
+        self._postponed = []
+        self._count = 0
+        self._oldest = None
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.retries = 0
+
+    def track(self, log_id, retry_count):
+        """Remembers how often a log has been retried, for its next backoff."""
+        self._retry_counts[log_id] = retry_count or 0
+
+    def add(self, log_id, result):
+        success, error = result
+        retry_count = self._retry_counts.pop(log_id, 0)
+        if success:
+            self._sent.append(log_id)
+        elif is_transient(error) and retry_count < self.max_retries:
+            delay = retry_delay(retry_count, self.retry_base, self.retry_max)
+            self._retry.append({
+                'log_id': log_id,
+                'retry_count': retry_count + 1,
+                'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay),
+                'error': str(error),
+            })
+        else:
+            self._failed.setdefault(str(error), []).append(log_id)
+        self._added()
+
+    def postpone(self, log_id, seconds):
+        """Hands a log back unsent, claimable again after `seconds` (its domain is backing off)."""
+        self._retry_counts.pop(log_id, None)
+        self._postponed.append({'log_id': log_id,
+                                'next_attempt_at': datetime.utcnow() + timedelta(seconds=seconds)})
+        self._added()
+
+    def _added(self):
+        self._count += 1
+        if self._oldest is None:
+            self._oldest = self._clock()
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self._count and (self._count >= self.max_rows or
+                            self._clock() - self._oldest >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        if not self._count:
+            return
+        start = time.perf_counter()
+        sent = failed = 0
+        if self._sent:
+            sent = db.session.execute(
+                update(EmailLog)
+                .where(EmailLog.id.in_(self._sent), EmailLog.status.in_(OPEN_STATUSES))
+                .values(status='sent', error_message=None)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        for error, ids in self._failed.items():
+            failed += db.session.execute(
+                update(EmailLog)
+                .where(EmailLog.id.in_(ids), EmailLog.status.in_(OPEN_STATUSES))
+                .values(status='failed', error_message=error)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        if self._retry:
+            # Releasing the lease lets any worker pick the retry up once due
+            table = EmailLog.__table__
+            db.session.execute(
+                update(table)
+                .where(table.c.id == bindparam('log_id'),
+                       or_(table.c.status == 'pending', table.c.status == 'retry'))
+                .values(status='retry', retry_count=bindparam('retry_count'),
+                        next_attempt_at=bindparam('next_attempt_at'), error_message=bindparam('error'),
+                        lease_owner=None, lease_expires_at=None),
+                self._retry
+            )
+            self.retries += len(self._retry)
+        if self._postponed:
+            # Same retry_count: the send was never attempted
+            table = EmailLog.__table__
+            db.session.execute(
+                update(table)
+                .where(table.c.id == bindparam('log_id'),
+                       or_(table.c.status == 'pending', table.c.status == 'retry'))
+                .values(status='retry', next_attempt_at=bindparam('next_attempt_at'),
+                        lease_owner=None, lease_expires_at=None),
+                self._postponed
+            )
+
+        # Atomic increments: several workers may share the campaign
+        if sent or failed:
+            db.session.execute(
+                update(Campaign)
+                .where(Campaign.id == self.campaign_id)
+                .values(sent_count=Campaign.sent_count + sent,
+                        failed_count=Campaign.failed_count + failed)
+                .execution_options(synchronize_session=False)
+            )
+        db.session.commit()
+        COMMIT_SECONDS.observe(time.perf_counter() - start, kind='results')
+        EMAILS_TOTAL.inc(sent, status='sent')
+        EMAILS_TOTAL.inc(failed, status='failed')
+        EMAILS_TOTAL.inc(len(self._retry), status='retry')
+        progress_cache.apply(self.campaign_id, sent, failed)
+
+        self.flushes += 1
+        self.rows_flushed += self._count
+        self._sent = []
+        self._failed = {}
+        self._retry = []
+        self._postponed = []
+        self._count = 0
+        self._oldest = None
+
+def _send_batch(batch, build, pipeline, flusher, handle_results):
+    """Feeds leased logs into the pipeline, applying results as they come back."""
+    for row in batch:
+        flusher.track(row.id, row.retry_count)
+        pipeline.put((row.id, row.email, build(row)), on_wait=handle_results)
+        handle_results()
+
+def process_job(job_id, worker_id, config):
+    """
+    Sends whatever this worker can lease from one job.
+    Returns the number of logs handled. Marks the job completed once the
+    campaign has no pending or retrying logs left.
+    """
+    job = SendJob.query.get(job_id)
+    if not job or job.status == 'completed':
+        return 0
+    campaign = Campaign.query.get(job.campaign_id)
+
+    try:
+        accounts = _sender_accounts(job)
+    except Exception as e:
+        metrics.error('worker', f"Decryption failed: {e}")
+        return 0
+
+    if not campaign or not any(account.password for account in accounts):
+        metrics.error('worker', f"Campaign {job.campaign_id} missing or Credentials missing.")
+        return 0
+
+    # Authenticated sessions reused across recipients, per sender account
+    # (or a local sink each, see MAIL_TRANSPORT)
+    senders = open_sender_pool(config, accounts)
+    if not senders.available():
+        senders.close()
+        metrics.error('worker', f"Campaign {job.campaign_id}: every sender account is paused, disabled or out of quota.")
+        return 0
+
+    if job.status == 'queued':
+        job.status = 'running'
+        job.started_at = datetime.utcnow()
+        db.session.commit()
+
+    lease_seconds = config.get('WORKER_LEASE_SECONDS', 300)
+    batch_size = config.get('WORKER_BATCH_SIZE', 50)
+
+    # Attachments are encoded once and shared by every recipient's message
+    attachment_cache = get_attachment_cache(config)
+    attachments = attachment_cache.parts_for(campaign.attachments)
+
+    # Each account keeps its own limits; together they can go as fast as
+    # their sum, within the campaign's limits
+    limits = senders.limits(campaign)
+    transmit = senders.transmit
+
+    campaign_id = campaign.id
+    # PROFILE_CAMPAIGNS: profile this run on the fetch, render and send threads
+    profiler = metrics.campaign_profiler(config, campaign_id)
+    if profiler:
+        transmit = profiler.wrap(transmit)
+    template = get_compiled_template(campaign)
+    merge_columns, build_merge_data = merge_field_loader(campaign_id, template.fields)
+    # Separate budgets per recipient domain, within the campaign's limits
+    scheduler = DomainScheduler(
+        limits['rate'],
+        concurrency=config.get('DOMAIN_CONCURRENCY', 2),
+        limits=parse_domain_map(config.get('DOMAIN_LIMITS'), parse_domain_limit),
+        groups=parse_domain_map(config.get('DOMAIN_GROUPS')),
+        backoff=config.get('DOMAIN_BACKOFF_SECONDS', 30),
+        max_backoff=config.get('DOMAIN_MAX_BACKOFF_SECONDS', 600),
+        max_queued=config.get('RENDER_QUEUE_SIZE', 200)
+    )
+    # Render ahead of SMTP on a background thread (or process pool)
+    pipeline = SendPipeline(
+        # With several accounts From is left to whichever one sends
+        (template, job.base_url, senders.from_address, attachments),
+        transmit,
+        TokenBucket(limits['rate'], limits['burst']),
+        scheduler,
+        max_workers=limits['max_connections'],
+        processes=config.get('RENDER_PROCESSES', 0),
+        profiler=profiler
+    )
+    flusher = ResultFlusher(
+        campaign_id,
+        max_rows=config.get('RESULT_FLUSH_ROWS', 100),
+        max_ms=config.get('RESULT_FLUSH_MS', 1000),
+        max_retries=config.get('RETRY_MAX_ATTEMPTS', 5),
+        retry_base=config.get('RETRY_BASE_SECONDS', 60),
+        retry_max=config.get('RETRY_MAX_SECONDS', 3600)
+    )
+
+    last_beat = [time.monotonic()]
+    def beat():
+        # Renew well before the lease runs out
+        if time.monotonic() - last_beat[0] >= lease_seconds / 3:
+            heartbeat(job, worker_id, lease_seconds)
+            last_beat[0] = time.monotonic()
+
+    def handle_results():
+        # Results are applied here so the DB session stays on this thread
+        for done_id, result in pipeline.results():
+            flusher.add(done_id, result)
+        for log_id, seconds in pipeline.postponed():
+            flusher.postpone(log_id, seconds)
+        flusher.maybe_flush()
+        senders.sync()
+        SEND_QUEUE_DEPTH.set(scheduler.queued)
+        beat()
+
+    handled = 0
+    try:
+        with profiler.running() if profiler else contextlib.nullcontext():
+            # Leave the rest pending once no account can send
+            while senders.available():
+                start = time.perf_counter()
+                batch = claim_batch(campaign_id, worker_id, batch_size, lease_seconds, merge_columns)
+                pipeline.fetch.record(time.perf_counter() - start, items=len(batch))
+                if not batch:
+                    break
+                handled += len(batch)
+                _send_batch(batch, build_merge_data, pipeline, flusher, handle_results)
+    finally:
+        for done_id, result in pipeline.close(on_wait=handle_results):
+            flusher.add(done_id, result)
+        for log_id, seconds in pipeline.postponed():
+            flusher.postpone(log_id, seconds)
+        flusher.flush()
+        SEND_QUEUE_DEPTH.set(0)
+        senders.sync(force=True)
+        senders.close()
+        if handled:
+            print(f"Campaign {campaign_id} sender stats: {senders.stats()}")
+            print(f"Campaign {campaign_id} attachment cache stats: {attachment_cache.stats()}")
+            print(f"Campaign {campaign_id} results: {flusher.rows_flushed} rows in {flusher.flushes} commits, {flusher.retries} scheduled for retry, "
+                  f"{scheduler.postponements} postponed for a paused domain")
+            print(f"Campaign {campaign_id} pipeline stats: {pipeline.stats()}")
+        if profiler and handled:
+            path = metrics.profile_path(config, campaign_id)
+            print(f"Campaign {campaign_id} profile written to {path}\n{profiler.dump(path)}")
+
+    # Logs waiting for a retry keep the job open; a later pass sends them
+    remaining = EmailLog.query.filter(EmailLog.campaign_id == campaign_id,
+                                      EmailLog.status.in_(OPEN_STATUSES)).count()
+    if not remaining:
+        job.status = 'completed'
+        job.finished_at = datetime.utcnow()
+        # Form-entered credentials are only needed while sending
+        job.sender_email = None
+        job.encrypted_password = None
+    job.heartbeat_at = datetime.utcnow()
+    db.session.commit()
+    return handled
+
+def run_worker(app, worker_id=None, once=False):
+    """
+    Polls for active jobs until interrupted (or after one pass with once=True).
+    Also refreshes campaign open/click totals every ROLLUP_INTERVAL seconds.
+    """
+    worker_id = worker_id or make_worker_id()
+    poll_interval = app.config.get('WORKER_POLL_INTERVAL', 5)
+    print(f"Worker {worker_id} started")
+    if app.config.get('METRICS_PORT'):
+        metrics.start_http_server(app.config['METRICS_PORT'])
+        print(f"Metrics on :{app.config['METRICS_PORT']}/metrics")
+
+    with app.app_context():
+        if app.config.get('AUTO_MIGRATE', True):
+            upgrade_schema()
+        while True:
+            rollup_if_stale(app.config.get('ROLLUP_INTERVAL', 60), app.config.get('ROLLUP_OVERLAP', 1000))
+
+            job_ids = [row.id for row in db.session.query(SendJob.id)
+                       .filter(SendJob.status.in_(('queued', 'running')))
+                       .order_by(SendJob.id)]
+            db.session.commit()
+
+            handled = 0
+            for job_id in job_ids:
+                try:
+                    handled += process_job(job_id, worker_id, app.config)
+                except Exception as e:
+                    db.session.rollback()
+                    metrics.error('worker', f"Worker error on job {job_id}: {e}")
+
+            if once:
+                return
+            if not handled:
+                time.sleep(poll_interval)
+
+def main():
+    from app import app
+    try:
+        run_worker(app)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()